@@ -0,0 +1,149 @@
+import argparse
+import itertools
+import json
+import subprocess
+import time
+import tracemalloc
+
+from tree_of_thoughts import TreeOfThoughts, MemorySink, ScriptedBackend, RecordingBackend, ReplayBackend, LMQLBackend
+
+# Runs a grid of search workloads and appends one JSON line of measurements per workload,
+# so results from different commits can be compared. Run from the repository root:
+#   PYTHONPATH=. python benchmarks/bench_search.py --widths 1x1,2x3,4x3 --depths 5,10 --criteria 1,4
+# By default the model is simulated by ScriptedBackend with the given latency. With
+# --backend lmql --cassette path, real responses are recorded; --backend replay plays them back.
+
+def make_config(n_criteria):
+    return {
+        "initial": {
+            "prefix": "Question: use 4 numbers and basic arithmetic operations (+-*/) to obtain ",
+            "suffix": ". Only choose one number each step.\nAnswer: Let's think step by step.",
+        },
+        "reasoning": {
+            "graded": {
+                "prefix": "Please assess the following reasoning, and choose an option for each point:\n```\n",
+                "suffix": "\n```\n\n",
+                "items": [f"Criterion {i} holds: " for i in range(n_criteria)],
+            },
+            "vital": {
+                "items": ["There is not a single math mistake in the reasoning: "],
+            },
+            "stopping": {
+                "prefix": "Has the following reasoning achieved a correct and satisfying answer to the initial question?\n```\n",
+                "suffix": "\n```\n\nAnswer: ",
+            },
+        },
+        "answer": {
+            "callback_prompt": {
+                "suffix": "In conclusion, in one expression it is written as: ",
+            },
+            "validation": {
+                "prefix": "Please answer the following questions about the expression `",
+                "suffix": "`. ",
+                "items": [
+                    ("Does the expression really equal $arg?", True),
+                    lambda s: len(s) > 0,
+                ],
+            },
+        },
+    }
+
+def make_backend(args):
+    if args.backend == "lmql":
+        return RecordingBackend(LMQLBackend(), args.cassette) if args.cassette else LMQLBackend()
+    if args.backend == "replay":
+        return ReplayBackend(args.cassette, latency=args.latency)
+
+    latency = (args.latency / 2, args.latency * 3 / 2) if args.latency else 0.0
+    return ScriptedBackend(finished=args.finish_rate, answers=lambda reasoning: reasoning[-12:], latency=latency, seed=args.seed)
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def search(args, n_active_leaves, n_branches, depth, n_criteria, pipelined, sinks=()):
+    tree = TreeOfThoughts(**make_config(n_criteria), backend=make_backend(args), max_iterations=depth, sinks=sinks, batch_evaluation=args.batch_evaluation)
+    arguments = [str(24 + i) for i in range(args.arguments)]
+    return arguments, tree.reason_many(arguments, n_active_leaves, n_branches, concurrency=args.concurrency, pipelined=pipelined)
+
+def run_workload(args, n_active_leaves, n_branches, depth, n_criteria, pipelined):
+    metrics = MemorySink()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    arguments, results = search(args, n_active_leaves, n_branches, depth, n_criteria, pipelined, sinks=[metrics])
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+
+    # tracing every allocation slows Python down, so memory gets a pass of its own
+    peak_memory = None
+    if not args.skip_memory:
+        tracemalloc.start()
+        search(args, n_active_leaves, n_branches, depth, n_criteria, pipelined)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    calls = metrics.summary()["calls"]
+    n_answers = sum(len(answers) for _, answers in results)
+
+    return {
+        "commit": args.commit,
+        "engine": "pipelined" if pipelined else "iterative",
+        "backend": args.backend,
+        "n_active_leaves": n_active_leaves,
+        "n_branches": n_branches,
+        "max_iterations": depth,
+        "n_criteria": n_criteria,
+        "arguments": len(arguments),
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "peak_memory_bytes": peak_memory,
+        "llm_calls": sum(query["calls"] for query in calls.values()),
+        "cached_calls": sum(query["cached"] for query in calls.values()),
+        "prompt_tokens": sum(query["prompt_tokens"] for query in calls.values()),
+        "completion_tokens": sum(query["completion_tokens"] for query in calls.values()),
+        "answers": n_answers,
+        "answers_per_second": n_answers / wall if wall else 0.0,
+        "calls": calls,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tree of thoughts search engine")
+    parser.add_argument("--widths", default="1x1,2x3", help="comma separated n_active_leaves x n_branches pairs")
+    parser.add_argument("--depths", default="5,10", help="comma separated max_iterations")
+    parser.add_argument("--criteria", default="1,4", help="comma separated numbers of graded criteria")
+    parser.add_argument("--engine", choices=["iterative", "pipelined", "both"], default="both")
+    parser.add_argument("--backend", choices=["scripted", "lmql", "replay"], default="scripted")
+    parser.add_argument("--cassette", help="cassette to record to (lmql) or replay from (replay)")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean simulated seconds per call")
+    parser.add_argument("--finish-rate", type=float, default=0.1, help="chance the scripted model calls a line of reasoning finished")
+    parser.add_argument("--arguments", type=int, default=4, help="arguments searched per workload")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-evaluation", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-memory", action="store_true", help="skip the second, traced pass that measures peak memory")
+    parser.add_argument("--output", default="bench_output.jsonl")
+    args = parser.parse_args()
+
+    if args.backend == "replay" and not args.cassette:
+        parser.error("--backend replay needs a --cassette")
+
+    args.commit = current_commit()
+    widths = [tuple(int(x) for x in width.split("x")) for width in args.widths.split(",")]
+    depths = [int(x) for x in args.depths.split(",")]
+    criteria = [int(x) for x in args.criteria.split(",")]
+    engines = [False, True] if args.engine == "both" else [args.engine == "pipelined"]
+
+    with open(args.output, "a") as f:
+        for (n_active_leaves, n_branches), depth, n_criteria, pipelined in itertools.product(widths, depths, criteria, engines):
+            result = run_workload(args, n_active_leaves, n_branches, depth, n_criteria, pipelined)
+            f.write(json.dumps(result) + "\n")
+            memory = "-" if result["peak_memory_bytes"] is None else f"{result['peak_memory_bytes'] / 1e6:.1f}MB"
+            print(f"{result['engine']:>9} {n_active_leaves}x{n_branches} depth {depth:>2} criteria {n_criteria}: "
+                  f"{result['wall_seconds']:.2f}s wall, {result['cpu_seconds']:.2f}s cpu, {result['llm_calls']} calls, "
+                  f"{result['prompt_tokens'] + result['completion_tokens']} tokens, {memory} peak, "
+                  f"{result['answers_per_second']:.2f} answers/s")
+
+if __name__ == "__main__":
+    main()
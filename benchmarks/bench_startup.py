@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures what a short-lived process pays before its first answer: importing
+# tree_of_thoughts, building a tree and making the first query. Every sample runs in
+# a fresh interpreter, and one JSON line per run is appended, tagged with the commit:
+#   PYTHONPATH=. python benchmarks/bench_startup.py --runs 10
+# With --backend lmql the first query also imports the LMQL runtime and compiles the
+# query (and calls the model); --compile only times compile_queries(), without a network.
+
+def child(backend, compile_only):
+    started = time.perf_counter()
+    import tree_of_thoughts
+    imported = time.perf_counter()
+
+    import asyncio
+    from bench_search import make_config
+
+    if compile_only:
+        tree_of_thoughts.compile_queries()
+        first_call = second_call = time.perf_counter()
+    else:
+        backend = tree_of_thoughts.LMQLBackend() if backend == "lmql" else tree_of_thoughts.ScriptedBackend()
+        tree = tree_of_thoughts.TreeOfThoughts(**make_config(1), backend=backend, cache=False)
+        asyncio.run(tree.is_finished("Step 1: 12 * 2 = 24"))
+        first_call = time.perf_counter()
+        asyncio.run(tree.is_finished("Step 1: 20 + 4 = 24"))
+        second_call = time.perf_counter()
+
+    print(json.dumps({
+        "import_seconds": imported - started,
+        "first_call_seconds": first_call - started, # import, tree and first query
+        "second_call_seconds": second_call - first_call,
+        "lmql_imported": "lmql" in sys.modules,
+    }))
+
+def sample(args):
+    command = [sys.executable, os.path.abspath(__file__), "--child", "--backend", args.backend] + (["--compile"] if args.compile else [])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH")])))
+    output = subprocess.run(command, capture_output=True, text=True, check=True, env=env).stdout
+    return json.loads(output.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark import time and time to first query")
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters to sample")
+    parser.add_argument("--backend", choices=["scripted", "lmql"], default="scripted")
+    parser.add_argument("--compile", action="store_true", help="time compiling every LMQL query instead of a first call")
+    parser.add_argument("--output", default="bench_output.jsonl")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.backend, args.compile)
+
+    from bench_search import current_commit
+
+    samples = [sample(args) for _ in range(args.runs)]
+    result = {
+        "commit": current_commit(),
+        "benchmark": "startup",
+        "backend": "compile" if args.compile else args.backend,
+        "runs": args.runs,
+        "lmql_imported": samples[-1]["lmql_imported"],
+    }
+    for field in ("import_seconds", "first_call_seconds", "second_call_seconds"):
+        values = [s[field] for s in samples]
+        result[field] = statistics.median(values)
+        result[field.replace("_seconds", "_min_seconds")] = min(values)
+
+    with open(args.output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+    print(f"{result['backend']:>8}: import {result['import_seconds'] * 1e3:.1f}ms, first call {result['first_call_seconds'] * 1e3:.1f}ms, "
+          f"second call {result['second_call_seconds'] * 1e3:.1f}ms (median of {args.runs}), lmql imported: {result['lmql_imported']}")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,56 @@
+import ast
+import operator
+import re
 from tree_of_thoughts import TreeOfThoughts
 
+# the arithmetic around each "=": a run of numbers, operators, brackets and spaces
+leading_arithmetic = re.compile(r"^[\d\s+\-*/x×÷().]*")
+trailing_arithmetic = re.compile(r"[\d\s+\-*/x×÷().]*$")
+operations = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+def evaluate(node):
+    # only numbers and + - * /, anything else isn't arithmetic
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in operations:
+        return operations[type(node.op)](evaluate(node.left), evaluate(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in operations:
+        return operations[type(node.op)](evaluate(node.operand))
+    raise ValueError("not arithmetic")
+
+def parse(text, from_left):
+    # value of the longest part of the run that is an expression, cutting words off the far end
+    text = text.replace("×", "*").replace("÷", "/").replace("x", "*").strip()
+    while text:
+        edge = text[0] if from_left else text[-1]
+        if edge.isdigit() or edge in ("(-" if from_left else ")."):
+            try:
+                return evaluate(ast.parse(text, mode="eval").body)
+            except (SyntaxError, ValueError):
+                pass
+        text = text[1:] if from_left else text[:-1]
+    return None
+
+def arithmetic_is_correct(thought, path):
+    # both sides of every "=" written in the new thought have to agree, no model call needed
+    sides = thought.split("=")
+    for left, right in zip(sides, sides[1:]):
+        try:
+            a = parse(trailing_arithmetic.search(left).group(), from_left=True)
+            b = parse(leading_arithmetic.search(right).group(), from_left=False)
+        except ZeroDivisionError:
+            return False
+        if a is not None and b is not None and abs(a - b) > 1e-6:
+            return False
+    return True
+
 tree_config = {
     "initial": { # sandwiches the argument passed to self.reason
         "prefix": "Question: use 4 numbers and basic arithmetic operations (+-*/) to obtain ",
@@ -18,17 +69,8 @@ tree_config = {
         },
         # both vital and fatal are applied to the reasoning after each new thought is generated
         "vital": {
-            "prefix": "Please assess the following reasoning, and choose an option for each point:\n```\n",
-            "suffix": "\n```\n",
-            "items": [ # if any of these questions are answered "no" the new leaf dies
-                "There is not a single math mistake in the reasoning: ",
-            ]
-        },
-        "fatal": { # if any of these questions are answered "yes" the new leaf dies
-            "prefix": "Please assess the following reasoning, and choose an option for each point.\n```\n",
-            "suffix": "\n```\n",
-            "items": [
-                "There is a math mistake in the reasoning: ",
+            "items": [ # if any of these are answered "no" (or return False) the new leaf dies
+                arithmetic_is_correct, # functions of (thought, path) run before any model call
             ]
         },
         "stopping": { # Applied at the start of each iteration to flag potential answers
@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+from tree_of_thoughts import TreeOfThoughts, Service, ScriptedBackend, compile_queries
+
+# Serves the 24 game as a long-running local service:
+#   PYTHONPATH=. python examples/serve.py --port 8080
+#   curl -X POST localhost:8080/reason -d '{"tree": "get_24", "argument": "24"}'
+# --scripted answers with ScriptedBackend instead of a model, for trying it out offline.
+
+tree_config = {
+    "initial": {
+        "prefix": "Question: use 4 numbers and basic arithmetic operations (+-*/) to obtain ",
+        "suffix": ". Only choose one number each step.\nAnswer: Let's think step by step.",
+    },
+    "reasoning": {
+        "graded": {
+            "prefix": "Please assess the following reasoning, and choose an option for each point:\n```\n",
+            "suffix": "\n```\n\n",
+            "items": [
+                "The reasoning is reliable and repeatable: ",
+                "We are getting closer to the answer: ",
+            ],
+        },
+        "vital": {
+            "items": ["There is not a single math mistake in the reasoning: "],
+        },
+        "stopping": {
+            "prefix": "Has the following reasoning achieved a correct and satisfying answer to the initial question?\n```\n",
+            "suffix": "\n```\n\nAnswer: ",
+        },
+    },
+    "answer": {
+        "callback_prompt": {
+            "suffix": "In conclusion, using (+,-,x,/) and obey PEDMAS, in one expression it is written as: ",
+        },
+        "callback_fn": lambda x: x.replace(".", "").strip(),
+        "validation": {
+            "prefix": "Please answer the following questions about the expression `",
+            "suffix": "`. ",
+            "items": [
+                ("Are four numbers used to obtain $arg?", True),
+                ("Does the expression really equal $arg?", True),
+            ],
+        },
+    },
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve tree of thoughts searches over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8, help="searches run at once")
+    parser.add_argument("--max-queue", type=int, default=64, help="searches waiting before requests are turned away")
+    parser.add_argument("--scripted", action="store_true")
+    args = parser.parse_args()
+
+    if args.scripted:
+        backend = ScriptedBackend(finished=0.3, answers=["(6 - 2) * (3 + 3)"], latency=(0.05, 0.2))
+    else:
+        backend = None
+        compile_queries() # pay for compilation before the first request instead of during it
+
+    service = Service({"get_24": TreeOfThoughts(**tree_config, backend=backend)}, workers=args.workers, max_queue=args.max_queue)
+    print(f"Serving on http://{args.host}:{args.port}")
+    asyncio.run(service.serve_forever(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# tree_of_thoughts is a single module at the repo root, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
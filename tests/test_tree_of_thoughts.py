@@ -0,0 +1,286 @@
+import asyncio
+import json
+
+import pytest
+
+from tree_of_thoughts import (
+    Checkpoint, PartialAnswers, QueryCache, Scheduler, ScriptedBackend, Service, ServiceBusy, ServiceClosed, Tree, TreeOfThoughts,
+)
+
+# everything runs against ScriptedBackend, so no model or network is needed
+
+def make_config(n_graded=1):
+    return {
+        "initial": {
+            "prefix": "Question: use 4 numbers and basic arithmetic operations (+-*/) to obtain ",
+            "suffix": ". Only choose one number each step.\nAnswer: Let's think step by step.",
+        },
+        "reasoning": {
+            "graded": {"items": [f"Criterion {i} holds: " for i in range(n_graded)]},
+            "vital": {"items": ["There is not a single math mistake in the reasoning: "]},
+            "stopping": {"prefix": "Has the following reasoning achieved an answer?\n", "suffix": "\nAnswer: "},
+        },
+        "answer": {
+            "validation": {"items": [("Does the expression really equal $arg?", True)]},
+        },
+    }
+
+def make_tree(backend=None, **kwargs):
+    return TreeOfThoughts(**make_config(kwargs.pop("n_graded", 1)), backend=backend or ScriptedBackend(), **kwargs)
+
+# scheduler
+
+def test_scheduler_cancelled_waiter_gives_its_slot_back():
+    async def main():
+        scheduler = Scheduler(max_in_flight=1)
+        release = asyncio.Event()
+
+        async def slow():
+            await release.wait()
+            return "slow"
+
+        async def fast():
+            return "fast"
+
+        first = asyncio.ensure_future(scheduler.run(slow))
+        await asyncio.sleep(0)
+        waiting = asyncio.ensure_future(scheduler.run(fast))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["waiting"] == 1
+
+        waiting.cancel()
+        release.set()
+        assert await first == "slow"
+        assert await scheduler.run(fast) == "fast"
+        assert scheduler.in_flight == 0
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(main())
+
+def test_scheduler_retries_only_transient_errors():
+    async def main():
+        scheduler = Scheduler(retries=2, backoff=0)
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConnectionError("dropped")
+            return "ok"
+
+        async def broken():
+            raise ValueError("bad prompt")
+
+        assert await scheduler.run(flaky) == "ok"
+        assert scheduler.retried == 1
+        with pytest.raises(ValueError):
+            await scheduler.run(broken)
+        assert scheduler.retried == 1
+        assert scheduler.in_flight == 0
+
+    asyncio.run(main())
+
+# cache
+
+def test_identical_queries_in_flight_are_coalesced():
+    backend = ScriptedBackend(pass_rate=1.0, latency=0.01)
+    tree = make_tree(backend, n_graded=2)
+    reasoning = "Question\nStep 1: 2 + 2 = 4"
+
+    async def main():
+        return await asyncio.gather(*[tree.evaluate_reasoning(reasoning) for _ in range(3)])
+
+    ratings = asyncio.run(main())
+    assert len(set(ratings)) == 1
+    assert backend.calls == {"validate_thought": 1, "grade": 2}
+    assert tree.cache.stats()["hits"] == 6
+
+class FailFirstCall(ScriptedBackend):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.failed = False
+
+    async def run(self, tree, name, model, *args, **kwargs):
+        if not self.failed:
+            self.failed = True
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+        return await super().run(tree, name, model, *args, **kwargs)
+
+def test_failed_query_in_flight_lets_waiters_ask_again():
+    backend = FailFirstCall(latency=0.01)
+    tree = make_tree(backend)
+
+    async def main():
+        return await asyncio.gather(*[tree.is_finished("Question\nStep 1: 2 + 2 = 4") for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert isinstance(results[0], ValueError)
+    assert results[1] == results[2]
+    assert backend.calls == {"is_finished": 1}
+    assert tree.cache.in_flight == {}
+
+def test_cache_file_survives_a_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = QueryCache(path=path, flush_every=3)
+    for i in range(4):
+        cache.put(f"key {i}", i)
+    cache.close()
+
+    reopened = QueryCache(path=path)
+    assert reopened.get("key 3") == (True, 3)
+    reopened.close()
+
+# checkpoints
+
+def test_checkpoint_resumes_an_interrupted_search(tmp_path):
+    path = str(tmp_path / "search.jsonl")
+    backend = ScriptedBackend(finished=0.0, pass_rate=1.0, ratings=(6, 9))
+
+    interrupted = make_tree(backend, max_iterations=6).reason("24", 2, 3, checkpoint=path, budget={"max_calls": 30})
+    assert isinstance(interrupted, PartialAnswers)
+    before, meta = Tree.load(path)
+    assert meta["argument"] == "24"
+
+    # a record torn by a crash is ignored, and cut off when the journal is reopened
+    with open(path, "a") as f:
+        f.write('{"op": "node", "id": 9')
+    resumed = make_tree(backend, max_iterations=6)
+    resumed.reason("24", 2, 3, checkpoint=path)
+    after, _ = Tree.load(path)
+
+    assert len(after.nodes) > len(before.nodes)
+    assert [after.values[id] for id in before.nodes] == [before.values[id] for id in before.nodes]
+    assert all(record["op"] for record in Checkpoint.read(path))
+    with open(path) as f:
+        assert all(json.loads(line) for line in f)
+
+    with pytest.raises(ValueError):
+        make_tree(backend).reason("25", 2, 3, checkpoint=path)
+
+# search
+
+def test_answers_are_not_expanded_again():
+    backend = ScriptedBackend(finished=0.6, answers=lambda reasoning: "answer after " + " | ".join(reasoning.splitlines()[1:]))
+    tree = make_tree(backend)
+
+    async def main():
+        return [answer async for answer in tree.stream_reason("24", 2, 3)]
+
+    answers = asyncio.run(main())
+    answer_nodes = {id for id in tree.tree.nodes if tree.tree.values[id] in answers}
+    assert answers
+    assert len(answers) == len(set(answers))
+    assert not any(tree.tree.parents[id] in answer_nodes for id in tree.tree.nodes)
+    assert not answer_nodes & set(tree.tree.stack)
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_partial_counts_leaves_cut_off_by_the_budget(pipelined):
+    backend = ScriptedBackend(finished=0.0, pass_rate=1.0, ratings=(6, 9))
+    tree = make_tree(backend)
+
+    answers = tree.reason("24", 2, 3, pipelined=pipelined, budget={"max_calls": 20})
+    assert isinstance(answers, PartialAnswers)
+    assert answers.partial is not None
+    assert answers.partial != tree.tree.get_context(1)
+
+def test_path_cache_only_holds_leaves_being_expanded():
+    backend = ScriptedBackend(finished=0.0, pass_rate=1.0, ratings=(6, 9))
+    tree = make_tree(backend, max_iterations=8)
+    tree.reason("24", 2, 3)
+
+    nodes = tree.tree
+    assert nodes.joined == {}
+    for id in list(nodes.nodes)[1:]:
+        walked, current = [], id
+        while current:
+            walked.append(nodes.values[current])
+            current = nodes.parents[current]
+        assert nodes.get_context(id) == "\n".join(reversed(walked))
+
+# service
+
+def make_service(latency=0.01, **kwargs):
+    backend = ScriptedBackend(finished=0.5, answers=["(6 - 2) * (3 + 3)"], latency=latency)
+    return Service({"24": make_tree(backend, max_iterations=3)}, **kwargs)
+
+def test_service_coalesces_identical_requests():
+    async def main():
+        service = make_service()
+        results = await asyncio.gather(*[service.submit("24", "24") for _ in range(5)])
+        service.close()
+        return service, results
+
+    service, results = asyncio.run(main())
+    assert all(result == results[0] for result in results)
+    assert service.counts["coalesced"] == 4
+    assert service.counts["completed"] == 1
+
+def test_service_rejects_requests_when_the_queue_is_full():
+    async def main():
+        service = make_service(latency=0.05, workers=1, max_queue=1)
+        running = asyncio.ensure_future(service.submit("24", "1"))
+        await asyncio.sleep(0.01) # the worker takes the first search off the queue
+        queued = asyncio.ensure_future(service.submit("24", "2"))
+        await asyncio.sleep(0)
+        with pytest.raises(ServiceBusy):
+            await service.submit("24", "3")
+        await asyncio.gather(running, queued)
+        service.close()
+        return service
+
+    service = asyncio.run(main())
+    assert service.counts["rejected"] == 1
+    assert service.counts["completed"] == 2
+
+def test_service_close_fails_pending_requests():
+    async def main():
+        service = make_service(latency=0.05, workers=1)
+        pending = [asyncio.ensure_future(service.submit("24", argument)) for argument in ("1", "2")]
+        await asyncio.sleep(0.01)
+        service.close()
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        with pytest.raises(ServiceClosed):
+            await service.submit("24", "3")
+        return results
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ServiceClosed) for result in results)
+
+async def http(port, method, path, body=b""):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), 10)
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(payload)
+
+def test_http_requests_always_get_a_response():
+    bad_requests = [
+        b"not json",
+        json.dumps({"argument": "24"}).encode(),
+        json.dumps({"tree": ["24"], "argument": "24"}).encode(),
+        json.dumps({"tree": "24", "argument": "24", "n_branches": "x"}).encode(),
+        json.dumps({"tree": "24", "argument": "24", "budget": {"max_cals": 3}}).encode(),
+    ]
+
+    async def main():
+        service = make_service()
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            ok = await http(port, "POST", "/reason", json.dumps({"tree": "24", "argument": "24", "budget": {"max_calls": 100}}).encode())
+            unknown = await http(port, "POST", "/reason", json.dumps({"tree": "nope", "argument": "24"}).encode())
+            bad = [await http(port, "POST", "/reason", body) for body in bad_requests]
+            stats = await http(port, "GET", "/stats")
+        finally:
+            service.close()
+        return ok, unknown, bad, stats
+
+    ok, unknown, bad, stats = asyncio.run(main())
+    assert ok[0] == 200 and "answers" in ok[1]
+    assert unknown[0] == 404
+    assert [status for status, _ in bad] == [400] * len(bad_requests)
+    assert stats[0] == 200 and stats[1]["completed"] == 1
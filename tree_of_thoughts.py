@@ -1,6 +1,19 @@
-import lmql
 import asyncio
-from collections import namedtuple
+import contextvars
+import functools
+import hashlib
+import heapq
+import importlib
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from array import array
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, BrokenExecutor
+from contextlib import aclosing, contextmanager
 
 color= {
     "black": lambda text: f"\033[30m{text}\033[0m",
@@ -13,10 +26,54 @@ color= {
     "white": lambda text: f"\033[37m{text}\033[0m",
 }
 
-# TODO: debug output writer
+MODEL = "openai/gpt-3.5-turbo" # keep in sync with the `from` clause of the queries below
+
+# the stage each query belongs to, models can be configured per stage or per query
+STAGES = {
+    "is_finished": "review",
+    "get_next_thought": "generation",
+    "get_next_thoughts": "generation",
+    "final_result": "conclusion",
+    "validate_thought": "evaluation",
+    "grade": "evaluation",
+    "evaluate_all": "evaluation",
+    "prompt_validate": "validation",
+    "summarize": "summary",
+}
+
+# decoders of the queries whose results only depend on their prompt, and so can be cached
+CACHED_QUERIES = {
+    "is_finished": "argmax",
+    "validate_thought": "argmax",
+    "grade": "argmax",
+    "prompt_validate": "argmax",
+    "evaluate_all": "argmax",
+    "summarize": "argmax",
+}
+
+# queries sampling several results in one call, which are returned as a list
+SAMPLED_QUERIES = {"get_next_thoughts"}
+
+# scheduling priority of each query, lower goes first: checking answers unblocks
+# results, while grading only refines the order of the frontier
+PRIORITIES = {
+    "prompt_validate": 0,
+    "final_result": 1,
+    "is_finished": 2,
+    "summarize": 2,
+    "validate_thought": 3,
+    "evaluate_all": 3,
+    "get_next_thought": 4,
+    "get_next_thoughts": 4,
+    "grade": 5,
+}
+
+# queries and stages whose prompts include the reasoning path, and so can have a context policy;
+# the evaluation queries all judge the same path, so they share the "evaluation" policy
+CONTEXT_KEYS = {"default", "review", "generation", "conclusion", "evaluation", "is_finished", "get_next_thoughts", "final_result"}
 
 PromptSandwich = namedtuple("PromptSandwich", ["prefix", "suffix", "items"])
-ReasoningPrompt = namedtuple("ReasoningPrompt", ["graded", "vital", "fatal", "stopping"])
+ReasoningPrompt = namedtuple("ReasoningPrompt", ["graded", "vital", "fatal", "stopping", "canonicalize"])
 AnswerPrompt = namedtuple("AnswerPrompt", ["callback_prompt", "callback_fn", "validation"])
 
 def create_prompt_sandwich(data):
@@ -25,12 +82,18 @@ def create_prompt_sandwich(data):
     items = data.get("items", [])
     return PromptSandwich(prefix=prefix, suffix=suffix, items=items)
 
+def canonical_state(thought, reasoning):
+    # default key for transpositions: the thought, ignoring case and spacing, after the same line of
+    # reasoning; equal steps in different places are only the same state according to a domain hook
+    return hashlib.sha1(" ".join(reasoning.lower().split()).encode()).hexdigest() + ":" + " ".join(thought.lower().split())
+
 def create_prompt_reasoning(data):
     graded = create_prompt_sandwich(data.get("graded", {}))
     vital = create_prompt_sandwich(data.get("vital", {}))
     fatal = create_prompt_sandwich(data.get("fatal", {}))
     stopping = create_prompt_sandwich(data.get("stopping", {}))
-    return ReasoningPrompt(graded=graded, vital=vital, fatal=fatal, stopping=stopping)
+    canonicalize = data.get("canonicalize", canonical_state)
+    return ReasoningPrompt(graded=graded, vital=vital, fatal=fatal, stopping=stopping, canonicalize=canonicalize)
 
 def create_prompt_answer(data):
     callback_prompt = create_prompt_sandwich(data.get("callback_prompt", {}))
@@ -38,87 +101,1076 @@ def create_prompt_answer(data):
     validation = create_prompt_sandwich(data.get("validation", {}))
     return AnswerPrompt(callback_prompt=callback_prompt, callback_fn=callback_fn, validation=validation)
 
+def batch_validator(fn):
+    # marks an answer validator as taking the list of all candidate results and returning a list of bools
+    fn.batch = True
+    return fn
+
+async def gather_all(*awaitables) -> list:
+    # asyncio.gather, except that a failure cancels the awaitables still running instead of orphaning them
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def all_pass(checks) -> bool:
+    # fail fast: the first falsy result cancels every check still running
+    tasks = [asyncio.ensure_future(check) for check in checks]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            if not await next_done:
+                return False
+        return True
+    finally:
+        for task in tasks:
+            task.cancel()
+
 class Node:
-    def __init__(self, id: int, value: int | float, parent_id: int | None):
+    # a view of one node in the columns of a Tree, so `node.value = ...` lands in the tree
+    __slots__ = ("tree", "id")
+
+    def __init__(self, tree, id: int):
+        self.tree = tree
         self.id = id
-        self.value = value
-        self.parent_id = parent_id
+
+    @property
+    def value(self) -> str:
+        return self.tree.values[self.id]
+
+    @value.setter
+    def value(self, value: str):
+        self.tree.set_value(self.id, value)
+
+    @property
+    def parent_id(self) -> int | None:
+        return self.tree.parents[self.id] or None
+
+    @property
+    def depth(self) -> int:
+        return self.tree.depths[self.id]
+
+class Frontier:
+    """
+    Viable leaves waiting to be expanded, kept in heaps so that pushing a leaf
+    and popping the top k are O(log n) regardless of how big the tree gets.
+
+    strategies:
+    - "best": global best-first on score, newest first among equal scores
+    - "beam": best-first within the deepest layer, backfilling from shallower layers
+    - "newest": most recently created leaves first (the original behaviour)
+    """
+    strategies = ("best", "beam", "newest")
+
+    def __init__(self, strategy: str = "best"):
+        if strategy not in self.strategies:
+            raise ValueError(f"Unknown search strategy {strategy!r}, expected one of {self.strategies}")
+
+        self.strategy = strategy
+        self.scores = {} # leaf id -> score, also the source of truth for membership
+        self.heaps = {} # depth -> heap for "beam", a single heap under 0 otherwise
+
+    def __contains__(self, id: int) -> bool:
+        return id in self.scores
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def __getitem__(self, id: int) -> int | float:
+        return self.scores[id]
+
+    # the rest of the old dict interface; adding a leaf takes push(), since beam needs its depth
+    def __iter__(self):
+        return iter(self.scores)
+
+    def __delitem__(self, id: int):
+        del self.scores[id]
+
+    def get(self, id: int, default=None):
+        return self.scores.get(id, default)
+
+    def keys(self):
+        return self.scores.keys()
+
+    def items(self):
+        return self.scores.items()
+
+    def push(self, id: int, score: int | float, depth: int = 0):
+        self.scores[id] = score
+
+        if self.strategy == "newest":
+            priority = (-id, id)
+        else:
+            priority = (-score, -id, id)
+
+        layer = depth if self.strategy == "beam" else 0
+        heapq.heappush(self.heaps.setdefault(layer, []), priority)
+
+    def discard(self, id: int):
+        # heap entries are removed lazily when they surface in pop_top
+        self.scores.pop(id, None)
+
+    def pop_top(self, n: int) -> list[int]:
+        selected_ids = []
+
+        for layer in sorted(self.heaps, reverse=True):
+            heap = self.heaps[layer]
+            while len(selected_ids) < n and heap:
+                id = heapq.heappop(heap)[-1]
+                if id in self.scores:
+                    del self.scores[id]
+                    selected_ids.append(id)
+
+            if not heap:
+                del self.heaps[layer]
+
+            if len(selected_ids) == n:
+                break
+
+        return selected_ids
+
+class Checkpoint:
+    """
+    Append-only JSON lines journal of a search: one record per tree change (new
+    node, popped leaves, finished expansion, link, answer) plus one per completed
+    iteration. Records are buffered and written every `flush_every` records and
+    at the end of every iteration, so a crash loses at most the work in flight.
+    A record torn by a crash is cut off when the journal is reopened, so new
+    records never get glued onto it.
+    """
+    def __init__(self, path: str, flush_every: int = 64):
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = []
+        self.file = open(path, "a")
+        self.file.truncate(Checkpoint.valid_length(path))
+
+    @staticmethod
+    def valid_length(path: str) -> int:
+        # bytes up to the end of the last complete record, what read() would get through
+        length = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                length += len(line)
+        return length
+
+    def record(self, op: str, **fields):
+        self.pending.append(json.dumps({"op": op, **fields}, default=str))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.file.write("\n".join(self.pending) + "\n")
+            self.pending = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    @staticmethod
+    def read(path: str):
+        with open(path) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    break
+
+    @staticmethod
+    def hashable(state):
+        # JSON turns tuple state keys into lists
+        return tuple(Checkpoint.hashable(x) for x in state) if isinstance(state, list) else state
+
+class NodeView:
+    # mapping of node id -> Node over the columns of a Tree, nodes are added with Tree.push
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __contains__(self, id) -> bool:
+        return isinstance(id, int) and 0 < id < len(self.tree.values)
+
+    def __getitem__(self, id: int) -> Node:
+        if id not in self:
+            raise KeyError(id)
+        return Node(self.tree, id)
+
+    def __len__(self) -> int:
+        return len(self.tree.values) - 1
+
+    def __iter__(self):
+        return iter(range(1, len(self.tree.values)))
+
+    def get(self, id: int, default=None):
+        return self[id] if id in self else default
+
+    def values(self):
+        return (self[id] for id in self)
+
+    def items(self):
+        return ((id, self[id]) for id in self)
 
 class Tree:
-    def __init__(self):
-        self.nodes = {}
-        self.stack = {}
+    """
+    Column store of thoughts: node ids index into arrays of parent ids, scores and
+    depths, and a list of interned thought strings (slot 0 is unused, a parent of 0
+    means no parent). The parent column doubles as a rope: a leaf only holds its
+    parent id and its own line, and its path is joined once, in a single pass,
+    when it is popped for expansion. That string is shared by every prompt made
+    while the leaf is expanded and dropped afterwards, so paths cost memory for
+    the leaves in flight only.
+
+    With transpositions, `states` maps canonical state keys to the node holding
+    that state (0 while it is being evaluated, -1 if it died), and `links` holds
+    the extra parent -> node edges of states reached from more than one leaf.
+    Leaves that reach a state while it is still being evaluated wait in `waiting`
+    and are linked once its node is pushed.
+
+    When a Checkpoint is attached as `journal`, every change is appended to it,
+    and Tree.load rebuilds the tree from that file.
+    """
+    def __init__(self, strategy: str = "best"):
+        self.values = [None]
+        self.parents = array("q", [0])
+        self.scores = array("d", [0.0])
+        self.depths = array("l", [0])
+        self.joined = {} # node id -> values from the root down to it, joined by newlines
+        self.expanding = set() # popped leaves that haven't finished expanding
+        self.summaries = {} # node id -> task summarizing the path down to the node, for bounded-context prompts
+        self.states = {}
+        self.links = {}
+        self.waiting = {} # state -> leaves that reached it while it was being evaluated
+
+        self.nodes = NodeView(self)
+        self.stack = Frontier(strategy)
         self.answers = []
-        self.id_counter = 0
-
-    def push(self, value: str, score: int | float, parent: Node):
+        self.journal = None
+        self.best_score = 0.0 # highest score of any thought so far, popped or not
+        self.exhausted = False # whether the search ran out of budget
+        self.partial = None # and if so, the reasoning of its best unfinished leaf
+
+    @property
+    def id_counter(self) -> int:
+        # read-only, ids come from the length of the columns
+        return len(self.values) - 1
+
+    def _append(self, value: str, score: int | float, parent_id: int) -> int:
+        self.values.append(sys.intern(value) if isinstance(value, str) else value)
+        self.parents.append(parent_id)
+        self.scores.append(score)
+        self.depths.append(self.depths[parent_id] + 1 if parent_id else 0)
+        if score > self.best_score:
+            self.best_score = score
+        return self.id_counter
+
+    def push(self, value: str, score: int | float, parent: Node, state=None, frontier: bool = True):
         # nodes have unique names, still determined by counter
-        # viable_leaf_ids is instead "data" and has keys for each of the nodes
-        self.id_counter += 1
-
+        # the frontier is instead "data" and holds the scores of viable leaves
+        # answers are recorded with frontier=False, so they are never expanded
         if parent.id not in self.nodes:
             raise ValueError(f"Parent node {parent.value} ({parent.id}) not in tree")
 
-        self.nodes[self.id_counter] = Node(self.id_counter, value, parent.id)
+        id = self._append(value, score, parent.id)
+        if frontier:
+            self.stack.push(id, score, self.depths[id])
+
+        if state is not None:
+            self.states[state] = id
+
+        if self.journal is not None:
+            self.journal.record("node", id=id, parent=parent.id, value=value, score=score, state=state, frontier=frontier)
+
+        if state is not None:
+            for parent_id in self.waiting.pop(state, ()):
+                self.merge(parent_id, id)
+
+    def set_value(self, id: int, value: str):
+        self.values[id] = sys.intern(value) if isinstance(value, str) else value
+        self.joined.clear() # joined paths through the node are stale, they are joined again on demand
+
+        if self.journal is not None:
+            self.journal.record("value", id=id, value=value)
+
+    def reach(self, parent_id: int, state):
+        # a leaf reached a state seen before: link it to that node, or once the node exists
+        id = self.states[state]
+        if id < 0:
+            return
+        if id == 0:
+            self.waiting.setdefault(state, []).append(parent_id)
+        else:
+            self.merge(parent_id, id)
 
-        self.stack[self.id_counter] = score
+    def merge(self, parent_id: int, id: int):
+        # links unless the edge is already there, or id is on the path to parent_id (a cycle)
+        if parent_id == self.parents[id] or id in self.links.get(parent_id, ()):
+            return
+        if self.ancestor(parent_id, self.depths[id]) == id:
+            return
+        self.link(parent_id, id)
+
+    def drop_state(self, state):
+        # the thought holding this state died, so nobody waiting gets a link
+        self.states[state] = -1
+        self.waiting.pop(state, None)
+
+    def link(self, parent_id: int, id: int):
+        self.links.setdefault(parent_id, []).append(id)
+
+        if self.journal is not None:
+            self.journal.record("link", parent=parent_id, id=id)
 
     def add_root(self, value: str) -> Node:
-        self.id_counter += 1
-        root_node = Node(self.id_counter, value, None)
-        self.nodes[self.id_counter] = root_node
+        id = self._append(value, 0, 0)
 
-        return root_node
+        if self.journal is not None:
+            self.journal.record("node", id=id, parent=0, value=value, score=0, state=None)
 
-    def mark_as_answer(self, id: int, root_id: int):
+        return self.nodes[id]
+
+    def mark_as_answer(self, id: int, root_id: int, result=None):
         self.answers.append((id, root_id))
 
+        if self.journal is not None:
+            self.journal.record("answer", id=id, root_id=root_id, result=result)
+
+    def mark_as_expanded(self, id: int):
+        # popped leaves that never get here are put back on the frontier when a checkpoint is loaded
+        self.expanding.discard(id)
+        self.joined.pop(id, None)
+        if self.journal is not None:
+            self.journal.record("expanded", id=id)
+
     def leaves_pop_top(self, n: int) -> list[int]:
-        # selected_leaf_ids = sorted(self.viable_leaf_ids, key=self.viable_leaf_ids.get, reverse=True)[:n]
-        # selected_leaf_ids = sorted(self.viable_leaf_ids, reverse=True)[:n]
-        selected_leaf_ids = []
-        i = self.id_counter
-        while len(selected_leaf_ids) < n and i > 0:
-            if i in self.stack:
-                selected_leaf_ids.append(i)
-            i -= 1
-
-        for leaf_id in selected_leaf_ids:
-            if self.nodes[leaf_id].parent_id:
-                del self.stack[leaf_id]
+        selected_leaf_ids = self.stack.pop_top(n)
+
+        self.expanding.update(selected_leaf_ids)
+
+        if self.journal is not None and selected_leaf_ids:
+            self.journal.record("pop", ids=selected_leaf_ids)
 
         return selected_leaf_ids
 
+    def requeue(self):
+        # puts popped leaves that never finished expanding back on the frontier, like Tree.load does
+        for id in self.expanding:
+            self.stack.push(id, self.scores[id], self.depths[id])
+            self.joined.pop(id, None)
+        self.expanding.clear()
+
+    def best_leaves(self, n: int) -> list[int]:
+        return sorted(self.stack.scores, key=lambda id: (self.stack.scores[id], id), reverse=True)[:n]
+
+    def dump(self, journal):
+        # writes a compact snapshot of the whole tree, e.g. to start a new checkpoint from it
+        for id in self.nodes:
+            journal.record("node", id=id, parent=self.parents[id], value=self.values[id], score=self.scores[id], state=None)
+        for state, id in self.states.items():
+            if id: # claims still being evaluated are made again after a resume
+                journal.record("state", state=state, id=id)
+        for parent_id, ids in self.links.items():
+            for id in ids:
+                journal.record("link", parent=parent_id, id=id)
+        journal.record("frontier", ids=list(self.stack.scores))
+        journal.flush()
+
+    @classmethod
+    def load(cls, path: str, strategy: str = "best") -> tuple["Tree", dict]:
+        """
+        Rebuilds a tree from a checkpoint, along with what is known about its search:
+        the argument, the last completed iteration, the number of expanded leaves and
+        the answers found. Leaves that were popped but never finished expanding go
+        back on the frontier. A torn last line from a crash is ignored.
+        """
+        tree = cls(strategy)
+        meta = {"argument": None, "iteration": 0, "expansions": 0, "answers": []}
+        popped = set()
+
+        for record in Checkpoint.read(path):
+            op = record["op"]
+            if op == "search":
+                meta["argument"] = record["argument"]
+            elif op == "node":
+                id = tree._append(record["value"], record["score"], record["parent"])
+                if record["parent"] and record.get("frontier", True):
+                    tree.stack.push(id, record["score"], tree.depths[id])
+                if record["state"] is not None:
+                    tree.states[Checkpoint.hashable(record["state"])] = id
+            elif op == "state":
+                tree.states[Checkpoint.hashable(record["state"])] = record["id"]
+            elif op == "link":
+                tree.links.setdefault(record["parent"], []).append(record["id"])
+            elif op == "value":
+                tree.values[record["id"]] = record["value"]
+            elif op == "pop":
+                for id in record["ids"]:
+                    tree.stack.discard(id)
+                    popped.add(id)
+            elif op == "expanded":
+                popped.discard(record["id"])
+                meta["expansions"] += 1
+            elif op == "frontier":
+                tree.stack = Frontier(strategy)
+                for id in record["ids"]:
+                    tree.stack.push(id, tree.scores[id], tree.depths[id])
+            elif op == "answer":
+                tree.answers.append((record["id"], record["root_id"]))
+                meta["answers"].append(record["result"])
+            elif op == "iteration":
+                meta["iteration"] = record["iteration"]
+
+        for id in popped:
+            tree.stack.push(id, tree.scores[id], tree.depths[id])
+
+        return tree, meta
+
+    def _join(self, id: int) -> str:
+        if id in self.joined:
+            return self.joined[id]
+
+        # walk up to the nearest joined ancestor (usually the root) and join the lines in one go
+        values = []
+        current = id
+        while current and current not in self.joined:
+            values.append(self.values[current])
+            current = self.parents[current]
+        if current:
+            values.append(self.joined[current])
+
+        joined = "\n".join(reversed(values))
+        if id in self.expanding:
+            self.joined[id] = joined
+
+        return joined
+
     def get_path(self, id: int) -> tuple[Node, str, dict]:
         if id not in self.nodes:
             raise ValueError(f"Node {id} not in tree")
 
-        node_values = []
-        leaf_node = self.nodes[id]
-        current_node = self.nodes[id]
-
-        while current_node is not None:
-            node_values.append(current_node.value)
-            if current_node.parent_id is not None:
-                current_node = self.nodes[current_node.parent_id]
-            else:
-                current_node = None
-
-        reasoning_path = node_values[1:]
-        reasoning_path = "\n".join(reversed(reasoning_path))
-
-        return leaf_node, reasoning_path, {}
+        # the parent's path is a prefix of the node's, which is joined while it is being expanded
+        if self.parents[id]:
+            path = self._join(id)
+            reasoning_path = path[:len(path) - len(self.values[id]) - 1]
+        else:
+            reasoning_path = ""
+
+        return self.nodes[id], reasoning_path, {}
+
+    def get_context(self, id: int) -> str:
+        # the reasoning path followed by the node itself, as it appears in prompts
+        if not self.parents[id]:
+            return "\n" + self.values[id]
+        return self._join(id)
+
+    def tail(self, id: int, n: int) -> list[int]:
+        # ids of the last n nodes on the path down to id, in root to leaf order
+        ids = []
+        while id and len(ids) < n:
+            ids.append(id)
+            id = self.parents[id]
+        return ids[::-1]
+
+    def ancestor(self, id: int, depth: int) -> int:
+        while self.depths[id] > depth:
+            id = self.parents[id]
+        return id
 
     def paths_pop_top(self, n) -> list[tuple[Node, str, dict]]:
         selected_leaf_ids = self.leaves_pop_top(n)
         return [self.get_path(id) for id in selected_leaf_ids]
 
+class QueryCache:
+    """
+    Content-addressed cache for deterministic queries, keyed on the rendered
+    prompt, model and decoder. A bounded in-memory LRU sits in front of an
+    optional sqlite file, so results also survive restarts. Writes to the file
+    are batched, `flush_every` rows per commit. Queries that are still running
+    are tracked as well, so an identical query asked meanwhile (e.g. by an
+    identical sibling thought) waits for that result instead of asking again.
+    """
+    def __init__(self, maxsize: int = 4096, path: str | None = None, flush_every: int = 64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.in_flight = {} # key -> future of (hit, value) for queries being asked right now
+        self.hits = 0
+        self.misses = 0
+        self.flush_every = flush_every
+        self.rows = [] # written to sqlite on the next flush
+
+        self.db = None
+        if path is not None:
+            import sqlite3 # only needed for persistent caches
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.commit()
+
+    @staticmethod
+    def key(name: str, model: str, decoder: str, prompt: str) -> str:
+        return hashlib.sha256(json.dumps([name, model, decoder, prompt]).encode()).hexdigest()
+
+    def get(self, key: str) -> tuple[bool, object]:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+
+        if self.db is not None:
+            row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._remember(key, value)
+                self.hits += 1
+                return True, value
+
+        self.misses += 1
+        return False, None
+
+    def begin(self, key: str):
+        self.in_flight[key] = asyncio.get_running_loop().create_future()
+
+    async def join(self, key: str) -> tuple[bool, object]:
+        # waits for the same query asked elsewhere, a miss if that one failed or was cancelled
+        hit, value = await asyncio.shield(self.in_flight[key])
+        if hit:
+            self.misses -= 1
+            self.hits += 1
+        return hit, value
+
+    def abandon(self, key: str):
+        future = self.in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result((False, None))
+
+    def put(self, key: str, value):
+        self._remember(key, value)
+
+        future = self.in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result((True, value))
+
+        if self.db is not None:
+            self.rows.append((key, json.dumps(value)))
+            if len(self.rows) >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        if self.db is not None and self.rows:
+            self.db.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", self.rows)
+            self.db.commit()
+            self.rows = []
+
+    def _remember(self, key: str, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.entries),
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+class TokenBucket:
+    def __init__(self, per_minute: int | float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def delay(self, amount: int | float) -> float:
+        # seconds until `amount` can be taken, requests bigger than the bucket wait for a full one
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: int | float):
+        self.tokens -= min(amount, self.capacity)
+
+# errors worth retrying: dropped connections, timeouts, and rate limits or overloads from API
+# clients, which are matched by class name so the clients don't have to be imported
+TRANSIENT_ERROR_NAMES = {"RateLimitError", "OpenAIRateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError", "ServiceUnavailableError", "Timeout"}
+
+def is_transient(error: BaseException) -> bool:
+    return isinstance(error, (ConnectionError, TimeoutError)) or any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+class Scheduler:
+    """
+    Gate for every model call: caps the number of requests in flight, keeps under
+    requests/min and tokens/min limits, retries transient failures with exponential
+    backoff, and hands free slots to the waiting call with the lowest priority value
+    first. `retry_on` is a tuple of exception types or a predicate on the exception.
+    One scheduler can be shared by any number of trees in the same process.
+    """
+    def __init__(self, max_in_flight: int = 16, requests_per_minute=None, tokens_per_minute=None, retries: int = 2, backoff: float = 1.0, retry_on=is_transient):
+        self.max_in_flight = max_in_flight
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+
+        self.in_flight = 0
+        self.waiting = [] # heap of (priority, seq, future)
+        self.seq = itertools.count()
+
+        self.submitted = 0
+        self.retried = 0
+        self.failed = 0
+        self.queued_seconds = 0.0
+
+    async def run(self, fn, priority: int = 0, tokens: int = 0):
+        self.submitted += 1
+
+        for attempt in range(self.retries + 1):
+            await self._acquire(priority, tokens)
+            try:
+                return await fn()
+            except Exception as e:
+                retry = isinstance(e, self.retry_on) if isinstance(self.retry_on, (tuple, type)) else self.retry_on(e)
+                if not retry or attempt == self.retries:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+            finally:
+                self._release()
+
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def _acquire(self, priority: int, tokens: int):
+        started = time.monotonic()
+
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            self.in_flight += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (priority, next(self.seq), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # the slot may have been handed over just before the cancellation
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+
+        # rate limits are waited out while holding the slot so priority order is kept
+        try:
+            while True:
+                delay = 0.0
+                if self.requests is not None:
+                    delay = max(delay, self.requests.delay(1))
+                if self.tokens is not None:
+                    delay = max(delay, self.tokens.delay(tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self._release()
+            raise
+
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+        self.queued_seconds += time.monotonic() - started
+
+    def _release(self):
+        # pass the slot straight to the next live waiter, skipping cancelled ones
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "retried": self.retried,
+            "failed": self.failed,
+            "in_flight": self.in_flight,
+            "waiting": len(self.waiting),
+            "queued_seconds": self.queued_seconds,
+        }
+
+def estimate_tokens(text) -> int:
+    # about four characters per token, close enough for accounting and rate limits
+    return len(text) // 4 if isinstance(text, str) else 0
+
+class Events:
+    """
+    Structured record of what a tree is doing. Every event is a dict with a type,
+    a timestamp and some fields, passed to each sink as it happens:
+    - "log": human readable progress text, only emitted for verbose runs
+    - "stage": how long a review/generation/evaluation/validation step took
+    - "call": one query, with its estimated prompt/completion tokens and whether it was cached
+    - "iteration": tree and frontier size, plus cache and scheduler stats
+    """
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+
+    def emit(self, type: str, **fields):
+        if not self.sinks:
+            return
+
+        event = {"type": type, "time": time.time(), **fields}
+        for sink in self.sinks:
+            sink(event)
+
+    def log(self, text: str):
+        self.emit("log", text=text)
+
+    @contextmanager
+    def stage(self, name: str, **fields):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.emit("stage", stage=name, seconds=time.perf_counter() - started, **fields)
+
+    @contextmanager
+    def terminal(self, enabled: bool = True):
+        # print progress for the duration of one search
+        if not enabled:
+            yield
+            return
+
+        sink = TerminalSink()
+        self.sinks.append(sink)
+        try:
+            yield
+        finally:
+            self.sinks.remove(sink)
+
+class TerminalSink:
+    # prints log text as it arrives instead of redrawing everything so far
+    def __call__(self, event: dict):
+        if event["type"] == "log":
+            print(event["text"], end="", flush=True)
+
+class MemorySink:
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event: dict):
+        self.events.append(event)
+
+    def of_type(self, type: str) -> list[dict]:
+        return [event for event in self.events if event["type"] == type]
+
+    def summary(self) -> dict:
+        calls = {}
+        for event in self.of_type("call"):
+            totals = calls.setdefault(event["query"], {"calls": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0})
+            totals["cached" if event["cached"] else "calls"] += 1
+            totals["prompt_tokens"] += event["prompt_tokens"]
+            totals["completion_tokens"] += event["completion_tokens"]
+            totals["seconds"] += event["seconds"]
+
+        stages = {}
+        for event in self.of_type("stage"):
+            totals = stages.setdefault(event["stage"], {"count": 0, "seconds": 0.0})
+            totals["count"] += 1
+            totals["seconds"] += event["seconds"]
+
+        return {"calls": calls, "stages": stages, "iterations": self.of_type("iteration")}
+
+class JSONLinesSink:
+    def __init__(self, path: str):
+        self.file = open(path, "a")
+
+    def __call__(self, event: dict):
+        self.file.write(json.dumps(event, default=str) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def call_key(name, model, args, kwargs) -> str:
+    return QueryCache.key(name, model, "", repr((args, sorted(kwargs.items()))))
+
+# the LMQL runtime is imported, and each query compiled, the first time a query runs,
+# so importing this module and running searches on other backends stays cheap
+compiled_queries = {} # query function -> compiled query, shared by every tree
+
+def load_lmql():
+    return importlib.import_module("lmql")
+
+def compile_query(fn):
+    if fn not in compiled_queries:
+        compiled_queries[fn] = load_lmql().query(fn)
+    return compiled_queries[fn]
+
+def lmql_query(fn):
+    @functools.wraps(fn)
+    async def query(self, *args, **kwargs):
+        return await compile_query(fn).__get__(self, type(self))(*args, **kwargs)
+
+    query.source = fn
+    return query
+
+def compile_queries():
+    # compiles every query up front, e.g. before a long-running process starts taking requests
+    for attr in vars(TreeOfThoughts).values():
+        if hasattr(attr, "source"):
+            compile_query(attr.source)
+
+class LMQLBackend:
+    # runs the LMQL queries defined on the tree, overriding their model when configured
+    async def run(self, tree, name, model, *args, **kwargs):
+        query = getattr(tree, "_" + name)
+        if model != MODEL:
+            kwargs["model"] = model
+        return await query(*args, **kwargs)
+
+class ScriptedBackend:
+    """
+    Offline, deterministic stand-in for a model. Answers are drawn from a random
+    generator seeded with the query and its arguments, so yes/no checks and grades
+    are stable, while sampled queries also count repeats of the same call to give
+    fresh samples, like a real model would. Each behaviour can be scripted:
+    - thoughts: list of thoughts to cycle through, or fn(reasoning, rng) -> str
+    - finished: probability a line of reasoning is done, or fn(reasoning) -> bool
+    - answers: list of conclusions to cycle through, or fn(reasoning) -> str
+    - ratings: (low, high) range of 1-9 grades, or fn(statement, reasoning) -> int
+    - pass_rate: probability a yes/no check comes out as expected, or fn(statement, reasoning) -> bool
+    - latency: seconds per call, or a (low, high) range
+    """
+    def __init__(self, thoughts=None, finished=0.2, answers=None, ratings=(1, 9), pass_rate=0.9, latency=0.0, seed=0):
+        self.thoughts = thoughts
+        self.finished = finished
+        self.answers = answers
+        self.ratings = ratings
+        self.pass_rate = pass_rate
+        self.latency = latency
+        self.seed = seed
+        self.calls = {}
+        self.samples = {} # call key -> times a sampled query was made with it
+
+    async def run(self, tree, name, model, *args, **kwargs):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+        key = call_key(name, model + str(self.seed), args, kwargs)
+        if name not in CACHED_QUERIES:
+            self.samples[key] = self.samples.get(key, 0) + 1
+            key += str(self.samples[key])
+        rng = random.Random(key)
+
+        latency = rng.uniform(*self.latency) if isinstance(self.latency, tuple) else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+
+        return getattr(self, name)(tree, rng, *args, **kwargs)
+
+    def _pick(self, script, rng, *args):
+        if callable(script):
+            return script(*args)
+        return script[rng.randrange(len(script))]
+
+    def _check(self, rng, statement, reasoning):
+        if callable(self.pass_rate):
+            return bool(self.pass_rate(statement, reasoning))
+        return rng.random() < self.pass_rate
+
+    def _rating(self, rng, statement, reasoning):
+        if callable(self.ratings):
+            return self.ratings(statement, reasoning) - 5
+        return rng.randint(*self.ratings) - 5
+
+    def get_next_thought(self, tree, rng, reasoning):
+        if self.thoughts is None:
+            return f"Step {reasoning.count(chr(10))}: option {rng.randint(1, 9)}"
+        if callable(self.thoughts):
+            return self.thoughts(reasoning, rng)
+        return self._pick(self.thoughts, rng)
+
+    def get_next_thoughts(self, tree, rng, reasoning, n):
+        return [self.get_next_thought(tree, random.Random(rng.random()), reasoning) for _ in range(n)]
+
+    def is_finished(self, tree, rng, reasoning):
+        if callable(self.finished):
+            return bool(self.finished(reasoning))
+        return rng.random() < self.finished
+
+    def final_result(self, tree, rng, reasoning):
+        result = "42" if self.answers is None else self._pick(self.answers, rng, reasoning)
+        if tree.answer.callback_fn:
+            return tree.answer.callback_fn(result)
+        return result
+
+    def prompt_validate(self, tree, rng, result, parsed_validation, should_be):
+        return self._check(rng, parsed_validation, result)
+
+    def summarize(self, tree, rng, reasoning):
+        return f"Summary of the reasoning so far: {reasoning.count(chr(10)) + 1} lines"
+
+    def validate_thought(self, tree, rng, prefix, suffix, statement, reasoning, should_be=True):
+        return self._check(rng, statement, reasoning)
+
+    def grade(self, tree, rng, statement, reasoning):
+        return self._rating(rng, statement, reasoning)
+
+    def evaluate_all(self, tree, rng, prefix, suffix, reasoning, checks, statements):
+        thought_validations = []
+        for statement, should_be in checks:
+            thought_validations.append(self._check(rng, statement, reasoning))
+            if not thought_validations[-1]:
+                return thought_validations, []
+
+        return thought_validations, [self._rating(rng, statement, reasoning) for statement in statements]
+
+class RecordingBackend:
+    # passes calls through to another backend and appends every response to a JSON lines cassette
+    def __init__(self, backend, path: str):
+        self.backend = backend
+        self.file = open(path, "a")
+
+    async def run(self, tree, name, model, *args, **kwargs):
+        result = await self.backend.run(tree, name, model, *args, **kwargs)
+        # JSON would turn a tuple result into a list, which reads as a list of LMQL results on replay
+        record = {"key": call_key(name, model, args, kwargs), "query": name, "result": result}
+        if isinstance(result, tuple):
+            record["tuple"] = True
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        return result
+
+    def close(self):
+        self.file.close()
+
+class ReplayBackend:
+    """
+    Serves responses from a cassette written by RecordingBackend. Repeated calls
+    with the same arguments (e.g. sampling several thoughts) get the recorded
+    responses in order, cycling when they run out. Calls that were never recorded
+    go to `fallback` if given, and raise KeyError otherwise.
+    """
+    def __init__(self, path: str, latency: float = 0.0, fallback=None):
+        self.responses = {}
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                result = tuple(record["result"]) if record.get("tuple") else record["result"]
+                self.responses.setdefault(record["key"], []).append(result)
+
+        self.served = {}
+        self.latency = latency
+        self.fallback = fallback
+
+    async def run(self, tree, name, model, *args, **kwargs):
+        key = call_key(name, model, args, kwargs)
+        if key not in self.responses:
+            if self.fallback is None:
+                raise KeyError(f"No recorded response for {name}")
+            return await self.fallback.run(tree, name, model, *args, **kwargs)
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        responses = self.responses[key]
+        served = self.served.get(key, 0)
+        self.served[key] = served + 1
+        return responses[served % len(responses)]
+
+class PartialAnswers(list):
+    """
+    What a search returns when its budget runs out: the answers found so far,
+    with the reasoning of the best unfinished leaf in `partial` (None if every
+    leaf died).
+    """
+    def __init__(self, answers=(), partial=None):
+        super().__init__(answers)
+        self.partial = partial
+
+class SamplingNotSupported(NotImplementedError):
+    # raised by backends that can't sample several results in one call
+    pass
+
+class ValidationTimeout(TimeoutError):
+    pass
+
+class BudgetExhausted(Exception):
+    pass
+
+class Budget:
+    """
+    Caps on model calls, estimated tokens (prompt and completion) and wall-clock
+    seconds since the budget was created, shared by every search that charges it.
+    Cache hits are free. The call that crosses a cap still completes; the next
+    one raises BudgetExhausted.
+    """
+    def __init__(self, max_calls: int | None = None, max_tokens: int | None = None, max_seconds: float | None = None):
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.calls = 0
+        self.tokens = 0
+        self.started = time.monotonic()
+
+    @property
+    def seconds(self) -> float:
+        return time.monotonic() - self.started
+
+    def seconds_left(self) -> float | None:
+        return None if self.max_seconds is None else max(0.0, self.max_seconds - self.seconds)
+
+    def remaining(self) -> float:
+        # fraction left of the tightest cap, 1.0 when nothing is capped
+        fractions = [1 - used / cap for used, cap in ((self.calls, self.max_calls), (self.tokens, self.max_tokens), (self.seconds, self.max_seconds)) if cap is not None]
+        return max(0.0, min(fractions, default=1.0))
+
+    @property
+    def exhausted(self) -> bool:
+        return self.remaining() <= 0
+
+    def charge(self, name: str, tokens: int = 0):
+        if self.max_calls is not None and self.calls >= self.max_calls:
+            raise BudgetExhausted(f"Call budget of {self.max_calls} exhausted before {name}")
+        if self.max_tokens is not None and self.tokens >= self.max_tokens:
+            raise BudgetExhausted(f"Token budget of {self.max_tokens} exhausted before {name}")
+        if self.max_seconds is not None and self.seconds >= self.max_seconds:
+            raise BudgetExhausted(f"Time budget of {self.max_seconds}s exhausted before {name}")
+        self.calls += 1
+        self.tokens += tokens
+
+    def spend(self, tokens: int):
+        self.tokens += tokens
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "tokens": self.tokens, "seconds": self.seconds, "remaining": self.remaining()}
+
+# budget of the search a query belongs to, set per search so concurrent searches don't share it
+search_budget = contextvars.ContextVar("search_budget", default=None)
+
 class TreeOfThoughts:
     initial: PromptSandwich
     reasoning: ReasoningPrompt
     answer: AnswerPrompt
 
-    def __init__(self, initial, reasoning, answer, max_iterations=10):
+    def __init__(self, initial, reasoning, answer, models=None, backend=None, max_iterations=10, strategy="best", cache=True, scheduler=None, batch_evaluation=False, speculative_grading=False, batch_sampling=True, budget=None, sinks=(), transpositions=False, validation_executor=None, validation_workers=4, validation_timeout=None, dynamic_width=False, context=None):
 
         self.initial = create_prompt_sandwich(initial)
         self.reasoning = create_prompt_reasoning(reasoning)
@@ -131,47 +1183,216 @@ class TreeOfThoughts:
 
         # self.params = {criteria: (1, 0) for criteria in self.graded_criteria} # TODO: use these in self.process_rating
 
-        self.tree = Tree()
+        # model per stage ("review", "generation", "conclusion", "evaluation", "validation") or per query,
+        # e.g. {"default": "openai/gpt-4", "evaluation": "openai/gpt-3.5-turbo"}
+        self.models = models or {}
+        self.backend = backend or LMQLBackend()
 
-        # TODO: memory, error propagation
+        self.strategy = strategy
+        self.tree = Tree(strategy)
+
+        # pass a QueryCache to share it between trees or persist it, or False to disable caching
+        self.cache = QueryCache() if cache is True else (cache or None)
 
-        self.verbose_buffer = ""
+        # pass a Scheduler to share concurrency and rate limits between trees
+        self.scheduler = scheduler or Scheduler()
 
-    def reason(self, argument, n_active_leaves, n_branches, verbose=False):
-        return asyncio.run(self.async_reason(argument, n_active_leaves, n_branches, verbose))
+        # ask for every fatal/vital/graded point in one query per thought instead of one query per point
+        self.batch_evaluation = batch_evaluation
 
-    def print_verbose(self):
-        # clear screen
-        print("\033c", end="")
-        print(self.verbose_buffer)
+        # start grading alongside the fatal/vital checks, cancelling it if the thought dies
+        self.speculative_grading = speculative_grading
 
-    async def async_reason(self, argument, n_active_leaves, n_branches, verbose=False):
-        self.verbose_buffer = ""
-        self.argument = argument
+        # sample all branches of a leaf in one call, falling back to one call per branch
+        # for models whose backend raises SamplingNotSupported (or NotImplementedError)
+        self.batch_sampling = batch_sampling
+        self.unbatched_models = set()
 
-        root_value = self.initial.prefix + argument + self.initial.suffix
-        root = self.tree.add_root(root_value)
+        # pass a Budget to cap the model calls of every search run by this tree,
+        # per search budgets are passed to reason/async_reason instead
+        self.budget = budget
+
+        # narrow the branching of weaker leaves, and of every leaf as the budget runs out
+        self.dynamic_width = dynamic_width
+
+        # how much of the reasoning path goes into prompts, per query, stage or "default":
+        # "full", {"window": k} for the root and the last k thoughts, or {"summary": k}
+        # to replace all but the last k to 2k-1 thoughts with a summary,
+        # e.g. {"default": {"window": 4}, "conclusion": "full"}
+        self.context = context or {}
+        for name, policy in self.context.items():
+            if name not in CONTEXT_KEYS:
+                raise ValueError(f"Unknown context key {name!r}, expected one of {sorted(CONTEXT_KEYS)}")
+            if policy != "full" and not (isinstance(policy, dict) and len(policy) == 1 and next(iter(policy)) in ("window", "summary") and policy[next(iter(policy))] >= 1):
+                raise ValueError(f"Unknown context policy {policy!r} for {name}, expected 'full', {{'window': k}} or {{'summary': k}} with k >= 1")
+
+        # merge thoughts reaching the same state (per reasoning["canonicalize"]) instead of evaluating them again
+        self.transpositions = transpositions
+
+        # where programmatic answer validators run: None for the event loop's default pool, "thread",
+        # "process" (validators must then be picklable, so no lambdas) or any concurrent.futures.Executor
+        self.validation_executor = validation_executor
+        self.validation_workers = validation_workers
+        self.validation_timeout = validation_timeout # seconds, a validator that takes longer raises ValidationTimeout
+        self._validation_pool = None
+
+        # where structured events go, e.g. MemorySink() or JSONLinesSink(path)
+        self.events = Events(sinks)
+
+        # TODO: memory, error propagation
+
+    def reason(self, argument, n_active_leaves, n_branches, verbose=False, pipelined=False, checkpoint=None, warm_start=None, budget=None):
+        return asyncio.run(self.async_reason(argument, n_active_leaves, n_branches, verbose, pipelined, checkpoint, warm_start, budget))
+
+    def reason_many(self, arguments, n_active_leaves, n_branches, concurrency=8, pipelined=False, budget=None):
+        async def collect():
+            return [result async for result in self.async_reason_many(arguments, n_active_leaves, n_branches, concurrency, pipelined, budget)]
+        return asyncio.run(collect())
+
+    async def async_reason_many(self, arguments, n_active_leaves, n_branches, concurrency=8, pipelined=False, budget=None):
+        """
+        Search many arguments on one event loop, with up to `concurrency` searches in
+        flight. Each search gets its own tree, while the cache, scheduler and the
+        tree's budget are shared. A `budget` dict gives each argument a budget of
+        its own. Yields (argument, answers) pairs in completion order.
+        """
+        arguments = iter(arguments)
+        results = asyncio.Queue()
+        done = object()
+
+        async def worker():
+            for argument in arguments:
+                try:
+                    answers = await self.async_reason(argument, n_active_leaves, n_branches, pipelined=pipelined, budget=budget)
+                except BudgetExhausted:
+                    answers = []
+                results.put_nowait((argument, answers))
+
+        async def run_workers():
+            # the first failure cancels every other worker too
+            try:
+                async with asyncio.TaskGroup() as group:
+                    for _ in range(concurrency):
+                        group.create_task(worker())
+                results.put_nowait(done)
+            except BaseExceptionGroup as e:
+                results.put_nowait(e.exceptions[0])
+
+        workers = asyncio.ensure_future(run_workers())
+        try:
+            while (result := await results.get()) is not done:
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            workers.cancel()
+            await asyncio.gather(workers, return_exceptions=True)
+
+    async def async_reason(self, argument, n_active_leaves, n_branches, verbose=False, pipelined=False, checkpoint=None, warm_start=None, budget=None):
+        """
+        checkpoint: path of a journal the search is recorded to. If it already holds a
+            search for this argument, that search is resumed where it stopped.
+        warm_start: path of an earlier search's checkpoint, whose best leaves seed this one.
+        budget: a Budget, or a dict like {"max_calls": 200, "max_tokens": 50000, "max_seconds": 30}
+            for a fresh one, capping this search. When it runs out the search stops and
+            returns PartialAnswers, holding the answers found so far and the best
+            partial reasoning, which is also emitted as a "budget" event.
+        """
+        budget = Budget(**budget) if isinstance(budget, dict) else budget
+        with self.events.terminal(verbose):
+            tree, meta = self.start_search(argument, n_active_leaves, checkpoint, warm_start, verbose)
+
+            if pipelined:
+                async with aclosing(self.stream_tree(tree, meta, argument, n_active_leaves, n_branches, 1, verbose, budget)) as stream:
+                    answers = [answer async for answer in stream]
+                return PartialAnswers(answers, tree.partial) if tree.exhausted else answers
+
+            token = search_budget.set(budget)
+            search = asyncio.ensure_future(self.iterate_reason(tree, meta, argument, n_active_leaves, n_branches, verbose))
+            search_budget.reset(token)
+            try:
+                # only the budget's deadline stops the search, timeouts from inside it are errors
+                await asyncio.wait([search], timeout=budget and budget.seconds_left())
+                if not search.done():
+                    raise BudgetExhausted(f"Time budget of {budget.max_seconds}s exhausted")
+                return search.result()
+            except BudgetExhausted:
+                token = search_budget.set(budget)
+                self.emit_exhausted(tree, argument, verbose)
+                search_budget.reset(token)
+                return PartialAnswers([], tree.partial)
+            finally:
+                if not search.done():
+                    search.cancel()
+                    await asyncio.wait([search])
+                if tree.journal is not None:
+                    tree.journal.close()
+                    tree.journal = None # later edits to the kept tree aren't part of the search
+
+    def start_search(self, argument, n_active_leaves, checkpoint=None, warm_start=None, verbose=False):
+        if checkpoint is not None and os.path.exists(checkpoint) and os.path.getsize(checkpoint):
+            tree, meta = Tree.load(checkpoint, self.strategy)
+            if meta["argument"] != argument:
+                raise ValueError(f"Checkpoint {checkpoint} is a search for {meta['argument']!r}, not {argument!r}")
+            tree.journal = Checkpoint(checkpoint)
+
+        elif warm_start is not None:
+            tree, meta = Tree.load(warm_start, self.strategy)
+            if meta["argument"] != argument:
+                raise ValueError(f"Checkpoint {warm_start} is a search for {meta['argument']!r}, not {argument!r}")
+
+            # keep the whole tree, but only its best leaves stay on the frontier
+            best_leaves = tree.best_leaves(n_active_leaves)
+            tree.stack = Frontier(self.strategy)
+            for id in best_leaves:
+                tree.stack.push(id, tree.scores[id], tree.depths[id])
+            tree.answers = []
+            meta = {"argument": argument, "iteration": 0, "expansions": 0, "answers": []}
+
+            if checkpoint is not None:
+                tree.journal = Checkpoint(checkpoint)
+                tree.journal.record("search", argument=argument)
+                tree.dump(tree.journal)
+
+        else:
+            tree = Tree(self.strategy)
+            meta = {"argument": argument, "iteration": 0, "expansions": 0, "answers": []}
+            if checkpoint is not None:
+                tree.journal = Checkpoint(checkpoint)
+                tree.journal.record("search", argument=argument)
+
+            root_value = self.initial.prefix + argument + self.initial.suffix
+            tree.add_root(root_value)
 
         if verbose:
-            self.verbose_buffer += color['cyan']( "ROOT ------------------------------------------------------\n")
-            self.verbose_buffer += root_value + "\n\n"
-            self.print_verbose()
+            self.events.log(color['cyan']( "ROOT ------------------------------------------------------\n"))
+            self.events.log(tree.values[1] + "\n\n")
+
+        self.tree = tree # a fresh tree per search, the latest one is kept for inspection
+        return tree, meta
 
-        current = 1
+    async def iterate_reason(self, tree, meta, argument, n_active_leaves, n_branches, verbose=False):
+        root = tree.nodes[1]
+        if meta["answers"]:
+            return meta["answers"] # the checkpointed search already finished
+
+        current = meta["iteration"] + 1
 
         while current <= self.max_iterations:
+            if self.out_of_budget():
+                raise BudgetExhausted(f"Budget exhausted before iteration {current}")
 
             if verbose:
-                self.verbose_buffer += color['green'](f"ITERATION {current}\n")
-                self.verbose_buffer += color['cyan']( "CHECKING FOR ANSWERABLE THOUGHTS --------------------------\n")
-                self.print_verbose()
+                self.events.log(color['green'](f"ITERATION {current}\n"))
+                self.events.log(color['cyan']( "CHECKING FOR ANSWERABLE THOUGHTS --------------------------\n"))
 
             # get (node, path_string) pairs, and default to the root if all leaves die
-            selected_leaves = self.tree.paths_pop_top(n_active_leaves)
+            selected_leaves = tree.paths_pop_top(n_active_leaves)
 
             if selected_leaves:
-                can_answer = await asyncio.gather(*[self.is_finished(path + "\n" + thought.value) for thought, path, attrs in selected_leaves])
-                can_answer = [x[0] for x in can_answer]
+                with self.events.stage("review", iteration=current):
+                    contexts = await self.contexts_for(tree, [thought.id for thought, path, attrs in selected_leaves], "is_finished")
+                    can_answer = await gather_all(*[self.is_finished(context) for context in contexts])
                 for i, is_answerable in enumerate(can_answer):
                     selected_leaves[i][2]["preceeds_answer"] = is_answerable
             else:
@@ -179,76 +1400,405 @@ class TreeOfThoughts:
 
             if verbose:
                 tally = sum(1 for _, _, meta in selected_leaves if meta.get('preceeds_answer', False))
-                self.verbose_buffer += f"  {tally} selected leaves are potential answers\n\n"
-                self.verbose_buffer += color['cyan']( "GENERATING NEXT THOUGHTS ----------------------------------\n")
-                self.print_verbose()
+                self.events.log(f"  {tally} selected leaves are potential answers\n\n")
+                self.events.log(color['cyan']( "GENERATING NEXT THOUGHTS ----------------------------------\n"))
 
             if verbose:
-                self.verbose_buffer += color['cyan']("\n------------------------------\n").join([reasoning_path + "\n" + color['blue'](leaf_node.value) + "\n" for leaf_node, reasoning_path, attrs in selected_leaves]) + "\n"
-                self.print_verbose()
+                self.events.log(color['cyan']("\n------------------------------\n").join([reasoning_path + "\n" + color['blue'](leaf_node.value) + "\n" for leaf_node, reasoning_path, attrs in selected_leaves]) + "\n")
 
+            contexts = await gather_all(*[self.context_for(tree, leaf.id, "final_result" if attrs["preceeds_answer"] else "get_next_thoughts") for leaf, _, attrs in selected_leaves])
             next_thoughts_list = []
-            for leaf_thought, reasoning_path, attrs in selected_leaves:
+            for (leaf_thought, reasoning_path, attrs), context in zip(selected_leaves, contexts):
                 if attrs["preceeds_answer"]:
-                    next_thoughts_list.append(self.final_result(reasoning_path + "\n" + leaf_thought.value))
+                    next_thoughts_list.append(self.final_result(context))
                 else:
-                    next_thoughts_list.append(self.get_next_thoughts(n_branches, reasoning_path + "\n" + leaf_thought.value))
+                    next_thoughts_list.append(self.get_next_thoughts(self.branches_for(tree, leaf_thought, n_branches), context))
+
+            with self.events.stage("generation", iteration=current):
+                next_thoughts_list = await gather_all(*next_thoughts_list)
+            next_thoughts_list = [[x] if attrs["preceeds_answer"] else x for (_, _, attrs), x in zip(selected_leaves, next_thoughts_list)]
 
-            next_thoughts_list = await asyncio.gather(*next_thoughts_list)
-            next_thoughts_list = [x if isinstance(x[0], str) else [y[0] for y in x] for x in next_thoughts_list]
+            states_list = []
+            for i, (leaf, reasoning_path, attrs) in enumerate(selected_leaves):
+                if attrs["preceeds_answer"]:
+                    states_list.append([None])
+                else:
+                    next_thoughts_list[i], states = self.new_states(tree, leaf, next_thoughts_list[i])
+                    states_list.append(states)
 
             if verbose:
                 tally = sum(len(x) for x in next_thoughts_list)
-                self.verbose_buffer += f"  {tally} new thoughts from here\n\n" 
-                self.verbose_buffer += color['cyan']( "ASSESSING THOUGHT PATHS -----------------------------------\n")
-                self.print_verbose()
-
-            thought_scores_list = []
-            for leaf_thought, next_thoughts in zip(selected_leaves, next_thoughts_list):
+                self.events.log(f"  {tally} new thoughts from here\n\n")
+                self.events.log(color['cyan']( "ASSESSING THOUGHT PATHS -----------------------------------\n"))
+
+            # attempted answers only have one branch, and are validated together
+            attempts = [next_thoughts[0] for (_, _, attrs), next_thoughts in zip(selected_leaves, next_thoughts_list) if attrs["preceeds_answer"]]
+            thought_scores_list = [self.validate_results(attempts, argument)]
+            contexts = await self.contexts_for(tree, [leaf.id for leaf, _, _ in selected_leaves], "evaluation")
+            for leaf_thought, next_thoughts, context in zip(selected_leaves, next_thoughts_list, contexts):
                 leaf, reasoning_path, attrs = leaf_thought
-                if attrs["preceeds_answer"]:
-                    thought_scores_list.append(*[self.validate_result(next_thoughts[0])]) # attempted answers only have one branch
-                else:
-                    thought_scores_list.append(asyncio.gather(*[self.evaluate_reasoning(reasoning_path + "\n" + leaf.value + "\n" + next_thought) for next_thought in next_thoughts]))
+                if not attrs["preceeds_answer"]:
+                    path = tree.get_context(leaf.id)
+                    thought_scores_list.append(gather_all(*[self.evaluate_reasoning(context + "\n" + next_thought, path) for next_thought in next_thoughts]))
 
-            thought_scores_list = await asyncio.gather(*thought_scores_list)
-            thought_scores_list = [x if isinstance(x, list) else [x] for x in thought_scores_list]
+            with self.events.stage("evaluation", iteration=current):
+                attempt_ratings, *thought_scores_list = await gather_all(*thought_scores_list)
+            attempt_ratings, thought_scores_list = iter(attempt_ratings), iter(thought_scores_list)
+            thought_scores_list = [[next(attempt_ratings)] if attrs["preceeds_answer"] else next(thought_scores_list) for _, _, attrs in selected_leaves]
 
             if verbose:
                 n_thoughts = sum(len(x) for x in thought_scores_list)
                 n_true = sum([1 for x in thought_scores_list for num in x if num > 0])
-                self.verbose_buffer += f"  {n_true}/{n_thoughts} of the new thoughts are viable\n"
-                self.print_verbose()
+                self.events.log(f"  {n_true}/{n_thoughts} of the new thoughts are viable\n")
 
             answers = []
-            for leaf_thought, next_thoughts, next_thought_ratings in zip(selected_leaves, next_thoughts_list, thought_scores_list):
+            for leaf_thought, next_thoughts, next_thought_ratings, states in zip(selected_leaves, next_thoughts_list, thought_scores_list, states_list):
                 leaf, reasoning_path, attrs = leaf_thought
-                for next_thought, rating in sorted(zip(next_thoughts, next_thought_ratings), key=lambda x: x[1], reverse=True):
+                for next_thought, rating, state in sorted(zip(next_thoughts, next_thought_ratings, states), key=lambda x: x[1], reverse=True):
                     if rating > 0:
-                        self.tree.push(next_thought, score=rating, parent=leaf)
+                        tree.push(next_thought, score=rating, parent=leaf, state=state, frontier=not attrs["preceeds_answer"])
+                    elif state is not None:
+                        tree.drop_state(state)
 
             # for leaf_thought, next_thought_ratings in zip(selected_leaves, thought_scores_list):
                 if leaf_thought[2]["preceeds_answer"] and next_thought_ratings[0] > 0:
                     answers.append(next_thoughts[0])
-                    self.tree.mark_as_answer(leaf.id, root.id)
+                    tree.mark_as_answer(leaf.id, root.id, next_thoughts[0])
+
+                tree.mark_as_expanded(leaf.id)
 
             if verbose:
-                self.verbose_buffer += f"  {len(answers)} answers passing validation\n\n"
-                self.print_verbose()
+                self.events.log(f"  {len(answers)} answers passing validation\n\n")
+
+            if tree.journal is not None:
+                tree.journal.record("iteration", iteration=current)
+                tree.journal.flush()
 
+            self.emit_iteration(tree, current, answers=len(answers))
             current += 1
 
             if answers:
                 return answers
 
         if verbose:
-            self.verbose_buffer += color['cyan']( "NO ANSWERS FOUND IN MAX STEPS -----------------------------\n\n")
-            self.print_verbose()
+            self.events.log(color['cyan']( "NO ANSWERS FOUND IN MAX STEPS -----------------------------\n\n"))
 
         return []
 
-    @lmql.query
+    def out_of_budget(self) -> bool:
+        return any(budget is not None and budget.exhausted for budget in (self.budget, search_budget.get()))
+
+    def branches_for(self, tree, leaf, n_branches) -> int:
+        """
+        With dynamic width, a leaf gets branches in proportion to its score relative
+        to the best thought in the tree so far, scaled down once less than half of
+        the tightest budget is left. Every leaf keeps at least one branch.
+        """
+        if not self.dynamic_width or leaf.id == 1:
+            return n_branches
+
+        relative = min(1.0, tree.scores[leaf.id] / tree.best_score) if tree.best_score > 0 else 1.0
+        remaining = min((budget.remaining() for budget in (self.budget, search_budget.get()) if budget is not None), default=1.0)
+
+        return max(1, min(n_branches, round(n_branches * relative * min(1.0, 2 * remaining))))
+
+    def emit_exhausted(self, tree, argument, verbose=False):
+        # the search ran out of budget, report how far it got, counting the leaves it was cut off in
+        tree.requeue()
+        best_leaves = tree.best_leaves(1)
+        tree.exhausted = True
+        tree.partial = tree.get_context(best_leaves[0]) if best_leaves else None
+        budget = search_budget.get() or self.budget
+        self.events.emit("budget", argument=argument, partial=tree.partial, answers=len(tree.answers), **(budget.stats() if budget else {}))
+
+        if verbose:
+            self.events.log(color['cyan']( "BUDGET EXHAUSTED ------------------------------------------\n\n"))
+
+    def emit_iteration(self, tree, iteration, **fields):
+        stats = {"nodes": len(tree.nodes), "frontier": len(tree.stack), "scheduler": self.scheduler.stats()}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        self.events.emit("iteration", iteration=iteration, **stats, **fields)
+
+    async def stream_reason(self, argument, n_active_leaves, n_branches, max_answers=None, verbose=False, checkpoint=None, warm_start=None, budget=None):
+        """
+        Barrier-free search: n_active_leaves workers each take the best leaf off the
+        frontier and carry it through review, expansion and evaluation on their own,
+        and answers are yielded as soon as they pass validation. At most
+        max_iterations * n_active_leaves leaves are expanded, and no more are started
+        once the budget runs out.
+        """
+        budget = Budget(**budget) if isinstance(budget, dict) else budget
+        with self.events.terminal(verbose):
+            tree, meta = self.start_search(argument, n_active_leaves, checkpoint, warm_start, verbose)
+            async with aclosing(self.stream_tree(tree, meta, argument, n_active_leaves, n_branches, max_answers, verbose, budget)) as stream:
+                async for answer in stream:
+                    yield answer
+
+    async def stream_tree(self, tree, meta, argument, n_active_leaves, n_branches, max_answers=None, verbose=False, budget=None):
+        root = tree.nodes[1]
+
+        max_expansions = self.max_iterations * n_active_leaves
+        state = {"started": meta["expansions"], "busy": 0, "finished": meta["expansions"], "exhausted": False}
+        changed = asyncio.Condition()
+        answers = asyncio.Queue()
+        done = object()
+
+        async def next_leaf():
+            async with changed:
+                while state["started"] < max_expansions:
+                    if state["exhausted"] or self.out_of_budget():
+                        state["exhausted"] = True
+                        return None
+
+                    selected_leaves = tree.paths_pop_top(1)
+                    if not selected_leaves and state["busy"] == 0:
+                        # every leaf died and nothing is in flight, so start again from the root
+                        selected_leaves = [(root, "", {})]
+
+                    if selected_leaves:
+                        state["started"] += 1
+                        state["busy"] += 1
+                        return selected_leaves[0]
+
+                    await changed.wait()
+
+                return None
+
+        async def worker():
+            while (selected_leaf := await next_leaf()) is not None:
+                try:
+                    leaf, reasoning_path, attrs = selected_leaf
+                    answer = await self.advance_leaf(tree, argument, leaf, reasoning_path, root, self.branches_for(tree, leaf, n_branches), verbose)
+                    if answer is not None:
+                        answers.put_nowait(answer)
+                except BudgetExhausted:
+                    state["exhausted"] = True
+                finally:
+                    async with changed:
+                        state["busy"] -= 1
+                        state["finished"] += 1
+                        changed.notify_all()
+                        self.emit_iteration(tree, state["finished"])
+
+        async def run_workers():
+            # the first failure cancels every other worker too
+            try:
+                async with asyncio.TaskGroup() as group:
+                    for _ in range(n_active_leaves):
+                        group.create_task(worker())
+                answers.put_nowait(done)
+            except BaseExceptionGroup as e:
+                answers.put_nowait(e.exceptions[0])
+
+        # answers already found by a checkpointed search come first
+        for answer in meta["answers"]:
+            answers.put_nowait(answer)
+
+        # the workers' tasks inherit the budget, this generator's caller doesn't
+        token = search_budget.set(budget)
+        workers = asyncio.ensure_future(run_workers())
+        search_budget.reset(token)
+
+        n_answers = 0
+        try:
+            while max_answers is None or n_answers < max_answers:
+                try:
+                    answer = await asyncio.wait_for(answers.get(), budget and budget.seconds_left())
+                except asyncio.TimeoutError:
+                    state["exhausted"] = True
+                    break
+                if answer is done:
+                    break
+                if isinstance(answer, Exception):
+                    raise answer
+
+                n_answers += 1
+                yield answer
+        finally:
+            workers.cancel()
+            await asyncio.gather(workers, return_exceptions=True)
+            if tree.journal is not None:
+                tree.journal.close()
+                tree.journal = None
+
+        # reaching max_answers is a finished search, even if another worker ran out of budget meanwhile
+        if state["exhausted"] and (max_answers is None or n_answers < max_answers):
+            token = search_budget.set(budget)
+            self.emit_exhausted(tree, argument, verbose)
+            search_budget.reset(token)
+        elif verbose and n_answers == 0:
+            self.events.log(color['cyan']( "NO ANSWERS FOUND IN MAX STEPS -----------------------------\n\n"))
+
+    async def advance_leaf(self, tree, argument, leaf, reasoning_path, root, n_branches, verbose=False):
+        # one leaf through review -> expand/conclude -> evaluate -> push, returns the answer if it passed
+        with self.events.stage("review"):
+            can_answer = leaf.id != root.id and await self.is_finished(await self.context_for(tree, leaf.id, "is_finished"))
+
+        if can_answer:
+            with self.events.stage("generation"):
+                result = await self.final_result(await self.context_for(tree, leaf.id, "final_result"))
+            rating = await self.validate_result(result, argument)
+
+            if verbose:
+                self.events.log(tree.get_context(leaf.id) + "\n" + color['blue'](str(result)) + "\n")
+                self.events.log(f"  answer {'passed' if rating > 0 else 'failed'} validation\n\n")
+
+            tree.mark_as_expanded(leaf.id)
+            if rating > 0:
+                tree.push(result, score=rating, parent=leaf, frontier=False)
+                tree.mark_as_answer(leaf.id, root.id, result)
+                return result
+            return None
+
+        with self.events.stage("generation"):
+            next_thoughts = await self.get_next_thoughts(n_branches, await self.context_for(tree, leaf.id, "get_next_thoughts"))
+        next_thoughts, states = self.new_states(tree, leaf, next_thoughts)
+        context = await self.context_for(tree, leaf.id, "evaluation")
+        with self.events.stage("evaluation"):
+            path = tree.get_context(leaf.id)
+            ratings = await gather_all(*[self.evaluate_reasoning(context + "\n" + next_thought, path) for next_thought in next_thoughts])
+
+        for next_thought, rating, state in sorted(zip(next_thoughts, ratings, states), key=lambda x: x[1], reverse=True):
+            if rating > 0:
+                tree.push(next_thought, score=rating, parent=leaf, state=state)
+            elif state is not None:
+                tree.drop_state(state)
+        tree.mark_as_expanded(leaf.id)
+
+        if verbose:
+            self.events.log(reasoning_path + "\n" + color['blue'](leaf.value) + "\n")
+            self.events.log(f"  {sum(1 for rating in ratings if rating > 0)}/{len(ratings)} of the new thoughts are viable\n\n")
+
+        return None
+
+    def new_states(self, tree, leaf, next_thoughts):
+        # drops thoughts whose state was already reached, linking the leaf to the node holding it instead
+        if not self.transpositions:
+            return next_thoughts, [None] * len(next_thoughts)
+
+        reasoning = tree.get_context(leaf.id)
+        fresh_thoughts, states = [], []
+        for next_thought in next_thoughts:
+            state = self.reasoning.canonicalize(next_thought, reasoning)
+            if state in tree.states:
+                tree.reach(leaf.id, state)
+                continue
+
+            tree.states[state] = 0 # claimed, replaced by the node id if the thought survives
+            fresh_thoughts.append(next_thought)
+            states.append(state)
+
+        self.events.emit("transpositions", leaf=leaf.id, generated=len(next_thoughts), fresh=len(fresh_thoughts))
+        return fresh_thoughts, states
+
+    async def context_for(self, tree, id, name) -> str:
+        # the reasoning path down to a node, as it should appear in the prompts of a query or stage
+        policy = self.context.get(name) or self.context.get(STAGES.get(name, name)) or self.context.get("default", "full")
+        if policy == "full":
+            return tree.get_context(id)
+
+        (kind, keep), = policy.items()
+        depth = tree.depths[id]
+
+        if kind == "window":
+            if depth <= keep:
+                return tree.get_context(id)
+            return "\n".join([tree.values[1], "...", *(tree.values[i] for i in tree.tail(id, keep))])
+
+        # summaries sit on every keep-th ancestor, so the tail is keep to 2 * keep - 1 thoughts long
+        anchor_depth = (depth // keep - 1) * keep
+        if anchor_depth < keep:
+            return tree.get_context(id)
+
+        anchor = tree.ancestor(id, anchor_depth)
+        summary = await self.summary_of(tree, anchor, keep)
+        return "\n".join([tree.values[1], summary, *(tree.values[i] for i in tree.tail(id, depth - anchor_depth))])
+
+    async def contexts_for(self, tree, ids, name) -> list[str]:
+        return await gather_all(*[self.context_for(tree, id, name) for id in ids])
+
+    async def summary_of(self, tree, id, keep) -> str:
+        # summarizes the previous summary plus the keep thoughts after it, once per node and shared by its descendants
+        if id not in tree.summaries:
+            async def summarize():
+                anchor_depth = tree.depths[id] - keep
+                segment = [tree.values[i] for i in tree.tail(id, keep)]
+                if anchor_depth >= keep:
+                    segment.insert(0, await self.summary_of(tree, tree.ancestor(id, anchor_depth), keep))
+                return await self.summarize("\n".join(segment))
+
+            tree.summaries[id] = asyncio.ensure_future(summarize())
+
+        # shielded, so one cancelled search path doesn't cancel a summary others are waiting on
+        return await asyncio.shield(tree.summaries[id])
+
+    def model_for(self, name):
+        return self.models.get(name) or self.models.get(STAGES[name]) or self.models.get("default", MODEL)
+
+    async def _query(self, name, prompt, *args, **kwargs):
+        # deterministic queries are looked up by their rendered prompt before being sent
+        key = None
+        if self.cache is not None and name in CACHED_QUERIES:
+            key = QueryCache.key(name, self.model_for(name), CACHED_QUERIES[name], prompt)
+            hit, value = self.cache.get(key)
+            while not hit and key in self.cache.in_flight:
+                hit, value = await self.cache.join(key)
+            if hit:
+                self.events.emit("call", query=name, cached=True, prompt_tokens=0, completion_tokens=0, seconds=0.0)
+                return value
+            self.cache.begin(key)
+
+        model = self.model_for(name)
+        tokens = estimate_tokens(prompt if prompt is not None else "".join(x for x in args if isinstance(x, str)))
+
+        budgets = [budget for budget in (search_budget.get(), self.budget) if budget is not None]
+        started = time.perf_counter()
+        try:
+            for budget in budgets:
+                budget.charge(name, tokens)
+            result = await self.scheduler.run(lambda: self.backend.run(self, name, model, *args, **kwargs), priority=PRIORITIES[name], tokens=tokens)
+        except BaseException:
+            if key is not None:
+                self.cache.abandon(key) # anyone waiting on this query asks it themselves
+            raise
+        if name not in SAMPLED_QUERIES:
+            result = result[0] if isinstance(result, list) else result
+
+        completion_tokens = sum(map(estimate_tokens, result)) if name in SAMPLED_QUERIES else estimate_tokens(result)
+        for budget in budgets:
+            budget.spend(completion_tokens)
+        self.events.emit("call", query=name, model=model, cached=False, prompt_tokens=tokens, completion_tokens=completion_tokens, seconds=time.perf_counter() - started)
+
+        if key is not None:
+            self.cache.put(key, result)
+
+        return result
+
     async def final_result(self, reasoning):
+        return await self._query("final_result", None, reasoning)
+
+    async def summarize(self, reasoning):
+        prompt = "Summarize the following reasoning in a few sentences, keeping every fact and intermediate result needed to continue it:\n```\n" + reasoning + "\n```\nSummary of the reasoning so far: "
+        return await self._query("summarize", prompt, reasoning)
+
+    @lmql_query
+    async def _summarize(self, reasoning):
+        '''lmql
+        argmax
+            "Summarize the following reasoning in a few sentences, keeping every fact and intermediate result needed to continue it:\n```\n"
+            "{reasoning}"
+            "\n```\nSummary of the reasoning so far: [summary]"
+            return "Summary of the reasoning so far: " + summary.strip()
+        from
+            "openai/gpt-3.5-turbo"
+        where
+            STOPS_BEFORE(summary, "\n") and
+            len(TOKENS(summary)) < 150
+        '''
+
+    @lmql_query
+    async def _final_result(self, reasoning):
         '''lmql
         sample()
             "{self.answer.callback_prompt.prefix}"
@@ -262,34 +1812,132 @@ class TreeOfThoughts:
             "openai/gpt-3.5-turbo"
         '''
 
-    async def validate_result(self, result):
+    async def validate_results(self, results, argument):
+        # batch validators see all of the candidates at once, then the rest run per result
+        passed = [True] * len(results)
+        for validation in self.answer.validation.items:
+            if results and getattr(validation, "batch", False):
+                verdicts = await self.run_validator(validation, list(results))
+                passed = [ok and bool(verdict) for ok, verdict in zip(passed, verdicts)]
+
+        async def failed():
+            return 0
+
+        return await gather_all(*[self.validate_result(result, argument, batched=True) if ok else failed() for result, ok in zip(results, passed)])
+
+    async def validate_result(self, result, argument, batched=False):
         if self.answer.validation.items:
-            loop = asyncio.get_event_loop()
             answer_validations = []
             for validation in self.answer.validation.items:
                 if isinstance(validation, tuple):
-                    answer_validations.append(self.prompt_validate(result, validation[0], validation[1]))
+                    answer_validations.append(self.prompt_validate(result, validation[0], validation[1], argument))
+                elif getattr(validation, "batch", False):
+                    if not batched:
+                        answer_validations.append(self.run_validator(validation, [result], single=True))
                 else:
-                    answer_validations.append(loop.run_in_executor(None, validation, result))
-                    # answer_validations.append(validation(result))
+                    answer_validations.append(self.run_validator(validation, result))
 
-            answer_validations = await asyncio.gather(*answer_validations)
-            answer_validations = [x[0] if isinstance(x, list) else x for x in answer_validations]
+            with self.events.stage("validation"):
+                passed = await all_pass(answer_validations)
 
-            if not all(answer_validations):
+            if not passed:
                 return 0 # below survival threshold
 
         return 1 # above survival threshold
 
-    @lmql.query
-    async def prompt_validate(self, result, validation, should_be):
+    def validation_pool(self) -> Executor | None:
+        if isinstance(self.validation_executor, Executor):
+            return self.validation_executor
+
+        # with a timeout the pool has to be ours, so a hung validator can be thrown out with it;
+        # a hung process can be killed, a hung thread runs on and holds up interpreter exit
+        executor = self.validation_executor
+        if executor is None and self.validation_timeout is not None and self._validation_pool is None:
+            executor = "process" if self.picklable_validators() else "thread"
+        if self._validation_pool is None and executor is not None:
+            from concurrent.futures import ProcessPoolExecutor # pulls in multiprocessing, so only when asked for
+            pools = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+            if executor not in pools:
+                raise ValueError(f"Unknown validation executor {executor!r}, expected 'thread', 'process' or an Executor")
+            self._validation_pool = pools[executor](max_workers=self.validation_workers)
+
+        return self._validation_pool
+
+    def picklable_validators(self) -> bool:
+        import pickle
+        try:
+            pickle.dumps([item for item in self.answer.validation.items if callable(item)])
+            return True
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return False
+
+    def recycle_validation_pool(self, pool):
+        # a hung validator holds its worker for good: kill the processes, or abandon the threads,
+        # and start the next validation on a fresh pool
+        if pool is None or pool is not self._validation_pool:
+            return
+
+        self._validation_pool = None
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def run_validator(self, validation, candidate, single=False):
+        pool = self.validation_pool()
+        if pool is None:
+            verdict = await asyncio.get_running_loop().run_in_executor(None, validation, candidate)
+            return verdict[0] if single else verdict
+
+        name = getattr(validation, "__name__", repr(validation))
+        for attempt in range(2):
+            future = pool.submit(validation, candidate)
+            waiting = asyncio.wrap_future(future)
+            waiting.add_done_callback(lambda f: f.cancelled() or f.exception()) # an abandoned call may still fail later
+            try:
+                while True:
+                    try:
+                        verdict = await asyncio.wait_for(asyncio.shield(waiting), self.validation_timeout)
+                        return verdict[0] if single else verdict
+                    except asyncio.TimeoutError:
+                        # only time validators that have started, not ones queued behind a slow one
+                        # (process pools mark a call as running once it is handed to a worker's queue)
+                        if not future.running() and not future.done():
+                            continue
+                        if pool is not self._validation_pool:
+                            break # recycled meanwhile, possibly for this very call, so try once on the new pool
+
+                        self.events.emit("validation_timeout", validator=name, seconds=self.validation_timeout)
+                        self.recycle_validation_pool(pool)
+                        raise ValidationTimeout(f"Validator {name} took longer than {self.validation_timeout}s") from None
+            except (BrokenExecutor, asyncio.CancelledError):
+                # the pool was recycled under us because another validator hung
+                if attempt or pool is self._validation_pool or asyncio.current_task().cancelling():
+                    raise
+            pool = self.validation_pool()
+
+        raise ValidationTimeout(f"Validator {name} took longer than {self.validation_timeout}s")
+
+    def close(self):
+        if self._validation_pool is not None:
+            self._validation_pool.shutdown(wait=False, cancel_futures=True)
+            self._validation_pool = None
+        if self.cache is not None:
+            self.cache.close()
+
+    async def prompt_validate(self, result, validation, should_be, argument):
+        parsed_validation = validation.replace('$arg', argument)
+        prompt = "( yes/no )\n" + self.answer.validation.prefix + result + self.answer.validation.suffix + parsed_validation
+        # the query returns whether the answer matched, so the expectation is part of the key
+        return await self._query("prompt_validate", prompt + f"\n{should_be}", result, parsed_validation, should_be)
+
+    @lmql_query
+    async def _prompt_validate(self, result, parsed_validation, should_be):
         """lmql
         argmax
             "( yes/no )\n"
             "{self.answer.validation.prefix}"
             "{result}"
             "{self.answer.validation.suffix}"
-            parsed_validation = validation.replace('$arg', self.argument)
             "{parsed_validation}"
             "[yn]"
             if yn.split()[-1]  in ["yes", "Yes"]:
@@ -309,12 +1957,38 @@ class TreeOfThoughts:
         """
 
     async def get_next_thoughts(self, n, reasoning):
-        thoughts = [self.get_next_thought(reasoning) for _ in range(n)]
-        return await asyncio.gather(*thoughts)
+        thoughts = []
+        model = self.model_for("get_next_thoughts")
+        if self.batch_sampling and n > 1 and model not in self.unbatched_models:
+            try:
+                thoughts = list(await self._query("get_next_thoughts", None, reasoning, n))[:n]
+            except NotImplementedError:
+                self.unbatched_models.add(model) # this model can't, so don't ask it again
+
+        # top up with single samples if the batched call returned too few
+        thoughts += await gather_all(*[self.get_next_thought(reasoning) for _ in range(n - len(thoughts))])
+        return thoughts
+
+    @lmql_query
+    async def _get_next_thoughts(self, reasoning, n):
+        '''lmql
+        sample(n=n)
+            "{reasoning}\n"
+            "[thought]"
+            return thought
+        from
+            "openai/gpt-3.5-turbo"
+        where
+            STOPS_BEFORE(thought, "\\n") and
+            STOPS_BEFORE(thought, "\n")
+        '''
 
-    # TODO: add continuation prompt (e.g. This next step is very important, so I am paying very close attention...)
-    @lmql.query
     async def get_next_thought(self, reasoning):
+        return await self._query("get_next_thought", None, reasoning)
+
+    # TODO: add continuation prompt (e.g. This next step is very important, so I am paying very close attention...)
+    @lmql_query
+    async def _get_next_thought(self, reasoning):
         '''lmql
         sample()
             "{reasoning}\n"
@@ -327,8 +2001,12 @@ class TreeOfThoughts:
             STOPS_BEFORE(thought, "\n")
         '''
 
-    @lmql.query
     async def is_finished(self, reasoning):
+        prompt = "(yes/no)\n" + self.reasoning.stopping.prefix + reasoning + self.reasoning.stopping.suffix
+        return await self._query("is_finished", prompt, reasoning)
+
+    @lmql_query
+    async def _is_finished(self, reasoning):
         '''lmql
         argmax
             "(yes/no)\n"
@@ -349,23 +2027,133 @@ class TreeOfThoughts:
             len(TOKENS(yn)) < 20
         '''
 
-    # TODO: programmatic constraints and evaluations
     # TODO: explore metaprompting for rating criteria
-    async def evaluate_reasoning(self, reasoning):
-        thought_validations = [self.validate_thought(self.reasoning.fatal.prefix, self.reasoning.fatal.suffix, statement, reasoning, should_be=False) for statement in self.reasoning.fatal.items]
-        thought_validations += [self.validate_thought(self.reasoning.vital.prefix, self.reasoning.vital.suffix, statement, reasoning, should_be=True) for statement in self.reasoning.vital.items]
-        thought_validations = await asyncio.gather(*thought_validations)
-        thought_validations = [x[0] for x in thought_validations]
+    # vital/fatal/graded items can be statements for the model, or functions of (thought, path):
+    # predicates for vital/fatal and scorers for graded, which run before any query is sent
+    def evaluate_programmatic(self, thought, path):
+        for statement in self.reasoning.fatal.items:
+            if callable(statement) and statement(thought, path):
+                return None
+        for statement in self.reasoning.vital.items:
+            if callable(statement) and not statement(thought, path):
+                return None
+
+        return sum(statement(thought, path) for statement in self.reasoning.graded.items if callable(statement))
+
+    async def evaluate_reasoning(self, reasoning, path=None):
+        # reasoning is the prompt context plus the new thought, path the whole path before the thought,
+        # which programmatic criteria get even when prompts only carry a window or summary of it
+        context, _, thought = reasoning.rpartition("\n")
+        score = self.evaluate_programmatic(thought, context if path is None else path)
+        if score is None:
+            return 0
+
+        if self.batch_evaluation:
+            return score + await self.evaluate_reasoning_batched(reasoning)
+
+        thought_validations = [self.validate_thought(self.reasoning.fatal.prefix, self.reasoning.fatal.suffix, statement, reasoning, should_be=False) for statement in self.reasoning.fatal.items if not callable(statement)]
+        thought_validations += [self.validate_thought(self.reasoning.vital.prefix, self.reasoning.vital.suffix, statement, reasoning, should_be=True) for statement in self.reasoning.vital.items if not callable(statement)]
+
+        if not self.speculative_grading:
+            if not await all_pass(thought_validations):
+                return 0
+
+            return score + await self.grade_all(reasoning)
+
+        evaluations = asyncio.ensure_future(self.grade_all(reasoning))
+        try:
+            if not await all_pass(thought_validations):
+                return 0
+            return score + await evaluations
+        finally:
+            evaluations.cancel()
+
+    async def grade_all(self, reasoning):
+        evaluations = [self.grade(statement, reasoning) for statement in self.reasoning.graded.items if not callable(statement)]
+        evaluations = await gather_all(*evaluations)
+        return sum(evaluations)
+
+    async def evaluate_reasoning_batched(self, reasoning):
+        checks = [(statement, False) for statement in self.reasoning.fatal.items if not callable(statement)]
+        checks += [(statement, True) for statement in self.reasoning.vital.items if not callable(statement)]
+        statements = [statement for statement in self.reasoning.graded.items if not callable(statement)]
+        if not checks and not statements:
+            return 0
+
+        thought_validations, evaluations = await self.evaluate_all(reasoning, checks, statements)
         if not all(thought_validations):
             return 0
 
-        evaluations = [self.grade(statement, reasoning) for statement in self.reasoning.graded.items]
-        evaluations = await asyncio.gather(*evaluations)
-        evaluations = [x[0] for x in evaluations]
         return sum(evaluations)
 
-    @lmql.query
+    async def evaluate_all(self, reasoning, checks, statements):
+        # the criteria share one framing, taken from the first section that has statements
+        sections = [self.reasoning.fatal, self.reasoning.vital, self.reasoning.graded]
+        framing = next((section for section in sections if any(not callable(statement) for statement in section.items)), self.reasoning.graded)
+
+        prompt = "( Answer yes/no to the checks, defaulting to the suggestion if not applicable. Rate the rest from 1 - 9 where 5 is neutral. If N/A choose 5. )\n"
+        prompt += framing.prefix + reasoning + framing.suffix
+        prompt += "".join(f"{statement} (default {'yes' if should_be else 'no'}): {should_be}\n" for statement, should_be in checks)
+        prompt += "".join(f"{statement}: \n" for statement in statements)
+        return await self._query("evaluate_all", prompt, framing.prefix, framing.suffix, reasoning, checks, statements)
+
+    # one hole per criterion, stopping at the first failed check since the thought is dead anyway
+    @lmql_query
+    async def _evaluate_all(self, prefix, suffix, reasoning, checks, statements):
+        '''lmql
+        argmax
+            "( Answer yes/no to the checks, defaulting to the suggestion if not applicable. Rate the rest from 1 - 9 where 5 is neutral. If N/A choose 5. )\n"
+            "{prefix}"
+            "{reasoning}"
+            "{suffix}"
+            thought_validations = []
+            for statement, should_be in checks:
+                default = "yes" if should_be else "no"
+                "{statement} (default {default}): [yn]\n"
+                if yn.split()[-1] in ["yes", "Yes"]:
+                    answer = True
+                else:
+                    answer = False
+                thought_validations.append(answer == should_be)
+                if answer != should_be:
+                    return thought_validations, []
+
+            evaluations = []
+            for statement in statements:
+                "{statement}: [rating]\n"
+                if rating[-1] in ["1", "2", "3", "4", "5", "6", "7", "8", "9"]:
+                    evaluations.append(int(rating[-1]) - 5)
+                else:
+                    evaluations.append(0) # no information if improperly answered
+
+            return thought_validations, evaluations
+        from
+            "openai/gpt-3.5-turbo"
+        where
+            STOPS_AT(yn, "yes") and
+            STOPS_AT(yn, "no") and
+            STOPS_AT(yn, "Yes") and
+            STOPS_AT(yn, "No") and
+            len(TOKENS(yn)) < 10 and
+            STOPS_AT(rating, "1") and
+            STOPS_AT(rating, "2") and
+            STOPS_AT(rating, "3") and
+            STOPS_AT(rating, "4") and
+            STOPS_AT(rating, "5") and
+            STOPS_AT(rating, "6") and
+            STOPS_AT(rating, "7") and
+            STOPS_AT(rating, "8") and
+            STOPS_AT(rating, "9") and
+            len(TOKENS(rating)) < 10
+        '''
+
     async def validate_thought(self, prefix, suffix, statement, reasoning, should_be=True):
+        default = "yes" if should_be else "no"
+        prompt = f"( Answer yes/no. If not applicable, default to {default}. )\n" + prefix + reasoning + suffix + f"{statement}: "
+        return await self._query("validate_thought", prompt + f"\n{should_be}", prefix, suffix, statement, reasoning, should_be=should_be)
+
+    @lmql_query
+    async def _validate_thought(self, prefix, suffix, statement, reasoning, should_be=True):
         '''lmql
         argmax
             default = "yes" if should_be else "no"
@@ -390,9 +2178,13 @@ class TreeOfThoughts:
             len(TOKENS(yn)) < 10
         '''
 
-    # TODO: replace ridiculous list of stops_at constraints if "in" constraints are supported for chat
-    @lmql.query
     async def grade(self, statement, reasoning):
+        prompt = "( rate each point from 1 - 9 where 5 is neutral. If N/A choose 5. )\n" + self.reasoning.graded.prefix + reasoning + self.reasoning.graded.suffix + f"{statement}: "
+        return await self._query("grade", prompt, statement, reasoning)
+
+    # TODO: replace ridiculous list of stops_at constraints if "in" constraints are supported for chat
+    @lmql_query
+    async def _grade(self, statement, reasoning):
         '''lmql
         argmax
             "( rate each point from 1 - 9 where 5 is neutral. If N/A choose 5. )\n"
@@ -421,3 +2213,188 @@ class TreeOfThoughts:
             STOPS_AT(rating, "9") and
             len(TOKENS(rating)) < 10
         '''
+
+class ServiceBusy(Exception):
+    pass
+
+class ServiceClosed(Exception):
+    pass
+
+class Service:
+    """
+    Long-running host for named trees, so their caches, scheduler and model
+    clients stay warm across requests. Searches are queued on a bounded queue and
+    run by `workers` tasks; a request is rejected with ServiceBusy when the queue
+    is full. Concurrent requests with the same tree, argument and search
+    parameters share one in-flight search.
+
+    submit() can be awaited from your own server, or start() serves JSON over HTTP:
+    - POST /reason {"tree": name, "argument": ..., "n_active_leaves": 2, "n_branches": 3, "pipelined": false, "budget": {...}}
+        -> {"answers": [...]}, plus "exhausted" and "partial" if the budget ran out,
+        400 for malformed requests or parameters, 404 for unknown trees, 503 when the
+        queue is full or the service is closed
+    - GET /stats -> queue, coalescing and per tree cache stats
+    """
+    def __init__(self, trees: dict[str, "TreeOfThoughts"], workers: int = 8, max_queue: int = 64, n_active_leaves: int = 2, n_branches: int = 3):
+        self.trees = trees
+        self.n_workers = workers
+        self.max_queue = max_queue
+        self.defaults = {"n_active_leaves": n_active_leaves, "n_branches": n_branches, "pipelined": False, "budget": None}
+
+        self.queue = None
+        self.workers = []
+        self.server = None
+        self.closed = False
+        self.in_flight = {} # request key -> future of its answers
+        self.counts = {"submitted": 0, "coalesced": 0, "rejected": 0, "completed": 0, "failed": 0}
+
+    async def submit(self, tree: str, argument: str, **params) -> list:
+        if tree not in self.trees:
+            raise KeyError(f"Unknown tree {tree!r}")
+        if self.closed:
+            raise ServiceClosed("The service has been closed")
+        self.start_workers()
+
+        params = {**self.defaults, **params}
+        key = json.dumps([tree, argument, params], sort_keys=True, default=str)
+
+        self.counts["submitted"] += 1
+        if key in self.in_flight:
+            self.counts["coalesced"] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(lambda f: f.cancelled() or f.exception()) # nobody may be waiting on it anymore
+            try:
+                self.queue.put_nowait((key, tree, argument, params, future))
+            except asyncio.QueueFull:
+                self.counts["rejected"] += 1
+                raise ServiceBusy(f"{self.max_queue} searches already queued")
+            self.in_flight[key] = future
+
+        # shielded, so a client hanging up doesn't cancel a search others share
+        return await asyncio.shield(self.in_flight[key])
+
+    def start_workers(self):
+        if self.queue is not None:
+            return # already started, by start() or the first submit()
+        self.queue = asyncio.Queue(self.max_queue)
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.n_workers)]
+
+    async def worker(self):
+        while True:
+            key, tree, argument, params, future = await self.queue.get()
+            try:
+                answers = await self.trees[tree].async_reason(argument, params["n_active_leaves"], params["n_branches"], pipelined=params["pipelined"], budget=params["budget"])
+                if not future.done():
+                    future.set_result(answers)
+                self.counts["completed"] += 1
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                self.counts["failed"] += 1
+            finally:
+                self.in_flight.pop(key, None)
+
+    def stats(self) -> dict:
+        trees = {name: tree.cache.stats() if tree.cache is not None else {} for name, tree in self.trees.items()}
+        return {"queued": self.queue.qsize() if self.queue else 0, "in_flight": len(self.in_flight), **self.counts, "trees": trees}
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080):
+        self.start_workers()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def serve_forever(self, host: str = "127.0.0.1", port: int = 8080):
+        server = await self.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+
+        # searches that are queued or running will never finish, so their callers have to hear about it
+        for future in self.in_flight.values():
+            if not future.done():
+                future.set_exception(ServiceClosed("The service was closed before the search finished"))
+        for worker in self.workers:
+            worker.cancel()
+        if self.server is not None:
+            self.server.close()
+        for tree in self.trees.values():
+            tree.close()
+
+    async def handle(self, reader, writer):
+        # just enough HTTP/1.1 for JSON requests, one request per connection, which always gets a response
+        try:
+            try:
+                method, path, _ = (await reader.readline()).decode().split(" ", 2)
+                headers = {}
+                while (line := (await reader.readline()).decode().strip()):
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response = await self.route(method, path, body)
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                status, response = 400, {"error": f"Bad request: {e}"}
+            except Exception as e:
+                status, response = 500, {"error": repr(e)}
+
+            payload = json.dumps(response, default=str).encode()
+            reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}
+            writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass # the client hung up, there is nobody to answer
+        finally:
+            writer.close()
+
+    @staticmethod
+    def check_params(params):
+        # bad search parameters are the client's mistake, raised as ValueError so they come back as 400
+        for name in ("n_active_leaves", "n_branches"):
+            if name in params and (type(params[name]) is not int or params[name] < 1):
+                raise ValueError(f"{name} should be a positive integer")
+        if "pipelined" in params and not isinstance(params["pipelined"], bool):
+            raise ValueError("pipelined should be true or false")
+
+        budget = params.get("budget")
+        if budget is None:
+            return
+        if not isinstance(budget, dict):
+            raise ValueError("budget should be an object")
+        caps = ("max_calls", "max_tokens", "max_seconds")
+        for name, value in budget.items():
+            if name not in caps:
+                raise ValueError(f"unknown budget cap {name!r}, expected one of {list(caps)}")
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                raise ValueError(f"budget cap {name} should be a non-negative number")
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/stats":
+            return 200, self.stats()
+        if method != "POST" or path != "/reason":
+            return 404, {"error": f"No route for {method} {path}"}
+
+        request = json.loads(body or b"{}")
+        if not isinstance(request, dict) or "tree" not in request or "argument" not in request:
+            raise ValueError("expected a JSON object with a tree and an argument")
+        if not isinstance(request["tree"], str):
+            raise ValueError("tree should be a string")
+        if request["tree"] not in self.trees:
+            return 404, {"error": f"Unknown tree {request['tree']!r}"}
+        params = {name: request[name] for name in self.defaults if name in request}
+        Service.check_params(params)
+
+        try:
+            answers = await self.submit(request["tree"], str(request["argument"]), **params)
+            if isinstance(answers, PartialAnswers):
+                return 200, {"answers": answers, "exhausted": True, "partial": answers.partial}
+            return 200, {"answers": answers}
+        except (ServiceBusy, ServiceClosed) as e:
+            return 503, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": repr(e)}